@@ -1,31 +1,67 @@
+import time
+
+startTime = time.perf_counter()
+
 import base64
 import http
 import io
+import mimetypes
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from functools import wraps
 
 import sqlalchemy
-from PIL import Image
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey, X25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.hashes import Hash, SHA256
 from cryptography.hazmat.primitives.padding import PKCS7
-from flask import Flask, request, jsonify, json, url_for, make_response
+from flask import Flask, request, jsonify, json, url_for, make_response, Response, stream_with_context, send_file, \
+    g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import MetaData
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event
+from werkzeug.http import is_resource_modified
 
+import compression
 import config
 import fb
+import filecache
+import imagecache
+import imagestore
+import keypool
+import metrics
+import paging
+import regioncache
+import rowformat
 import secrets
+import sessions
+import spatial
+import tablecache
+import upsert
 import utils
 from mysqlCreateTables import MySqlCreateTables
 
 MAX_IMAGE_SIZE = (10 * 1024 * 1024)
 MAX_CONFIG_SIZE = (10 * 1024)
+DATE_FORMAT = "%Y.%m.%d %H:%M:%S"
+STREAM_BATCH_SIZE = 500
+TABLE_CACHE_TTL = 60  # seconds until a reflected table is checked again
+IMAGE_CACHE_DIR = "imagecache"
+IMAGE_CACHE_SIZE = (256 * 1024 * 1024)
+THUMBNAIL_SIZES = [100, 400]  # maxdim values created after an upload
+FILE_CACHE_ENTRIES = 1000
+REGION_CACHE_ROWS = 200000
+REGION_CACHE_TTL = 30  # seconds until rows written by other processes show up in /region
+PAGE_SIZE_MAX = 5000  # rows per page of /table and /region with ?limit= or ?cursor=
+CLUSTER_PIXELS = 64  # size of a /clusters cell on the map, of a 256 pixel tile
+MAX_ZOOM = 22
+REGION_CACHE_TILES = 400  # viewports covering more grid tiles go to the database directly
+SYNC_MAX_ITEMS = 10000  # rows and image refs of one /sync request
+CHANGES_LAG = 60  # seconds, /changes returns an until this far back, for transactions still running
+KEX_POOL_SIZE = 256  # pregenerated keypairs for /kex, about the clients reconnecting after a restart
+
+
+INTERNAL_COLUMNS = spatial.SPATIAL_COLUMNS + (upsert.CHANGED_COLUMN,)  # not sent to or taken from clients
 
 
 class DecEncoder(json.JSONEncoder):
@@ -33,26 +69,104 @@ class DecEncoder(json.JSONEncoder):
         if isinstance(obj, Decimal):
             return float(obj)
         elif isinstance(obj, datetime):
-            return obj.strftime("%Y.%m.%d %H:%M:%S")
+            return obj.strftime(DATE_FORMAT)
         else:
             return super().default(obj)
 
 
+startupTimes = {"import": time.perf_counter() - startTime}
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = secrets.dburl
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['USE_X_SENDFILE'] = getattr(secrets, "use_x_sendfile", False)  # needs mod_xsendfile
 db = SQLAlchemy(app)
 app.json_encoder = DecEncoder
 
 print("SQLAlchemy version", sqlalchemy.__version__)
-meta = MetaData()
-meta.reflect(bind=db.engine)
-dbtables = meta.tables
+dbtables = tablecache.TableCache(db.engine, TABLE_CACHE_TTL)  # tables are reflected on first use
+t0 = time.perf_counter()
 fb.init(app)
+startupTimes["fb.init"] = time.perf_counter() - t0
+imageCache = imagecache.ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_SIZE)
+fileCache = filecache.FileCache(FILE_CACHE_ENTRIES)  # configs and marker codes
+regionCache = regioncache.RegionCache(REGION_CACHE_ROWS, REGION_CACHE_TILES, REGION_CACHE_TTL)
+postProcessor = imagestore.PostProcessor(imageCache, THUMBNAIL_SIZES, threads=1, queueSize=100)
+keyPool = keypool.KeyPool(KEX_POOL_SIZE)
+
+LOGIN_OK_DAYS = 12  # then the client is asked to log in again
+LOGIN_MAX_DAYS = 24
+TOMBSTONE_DAYS = LOGIN_MAX_DAYS  # deleted rows are kept this long for /changes, older since need a full resync
+SESSION_MAX = 10000
+if getattr(secrets, "session_db", None) is None:
+    sessionStore = sessions.MemoryStore(SESSION_MAX, LOGIN_MAX_DAYS * 24 * 60 * 60)
+else:  # shared by all WSGI processes
+    sessionStore = sessions.SqliteStore(secrets.session_db, SESSION_MAX, LOGIN_MAX_DAYS * 24 * 60 * 60)
+metrics.Gauge("locations_sessions", "Sessions in the session store", sessionStore.count)
+metrics.Gauge("locations_imagecache_bytes", "Size of the derived image cache", lambda: imageCache.size)
+metrics.Gauge("locations_kex_pool_keys", "Keypairs available in the /kex key pool", keyPool.available)
+startupTimes["total"] = time.perf_counter() - startTime
+print("startup times: " + ", ".join(phase + " " + str(int(secs * 1000)) + " ms" for (phase, secs) in startupTimes.items()))
+metrics.Gauge("locations_startup_seconds", "Duration of the startup phases of this process",
+              lambda: {(phase,): secs for (phase, secs) in startupTimes.items()}, ("phase",))
+
+
+@app.before_request
+def startTimer():
+    g.requestStart = time.perf_counter()
+
+
+@app.after_request
+def recordRequest(resp):
+    endpoint = request.endpoint or "unknown"
+    if "requestStart" in g:  # a streamed response is measured until its first byte
+        metrics.requestSeconds.observe((endpoint, request.method), time.perf_counter() - g.requestStart)
+    metrics.requestCount.inc((endpoint, str(resp.status_code)))
+    if resp.content_length is not None:
+        metrics.responseBytes.observe((endpoint,), resp.content_length)
+    return resp
+
+
+@app.after_request
+def compressResponse(resp):
+    # runs before recordRequest, so that the metrics see the compressed size
+    if resp.status_code != 200 or resp.direct_passthrough or resp.mimetype not in rowformat.formats or \
+            "Content-Encoding" in resp.headers:
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = compression.negotiate(request.accept_encodings)
+    if encoding is None:
+        return resp
+    if resp.is_streamed:
+        resp.response = compression.compressStream(encoding, resp.iter_encoded())
+        resp.headers.pop("Content-Length", None)
+    else:
+        data = resp.get_data()
+        if len(data) < compression.MIN_SIZE:
+            return resp
+        resp.set_data(compression.compress(encoding, data))
+    resp.headers["Content-Encoding"] = encoding
+    (etag, weak) = resp.get_etag()
+    if etag is not None:  # each encoding is a different representation
+        resp.set_etag(etag + "-" + encoding, weak)
+    return resp
+
+
+@event.listens_for(db.engine, "before_cursor_execute")
+def beforeExecute(conn, cursor, statement, parameters, context, executemany):
+    # on the context of the statement, not the connection: after_cursor_execute is not called if it fails
+    if context is not None:
+        context.executeStart = time.perf_counter()
 
-id2sharedKey = {}  # id -> secretKey
-id2loginDate = {}  # id -> datetime
-id2username = {}  # id -> username
+
+@event.listens_for(db.engine, "after_cursor_execute")
+def afterExecute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "executeStart", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = (request.endpoint or "unknown") if has_request_context() else "none"
+    metrics.dbSeconds.observe((endpoint,), elapsed)
 
 
 # for tablename in dbtables.keys():
@@ -60,17 +174,17 @@ id2username = {}  # id -> username
 #     for column in dbtable.columns:
 #         print(tablename, column.name, column.type)
 
-def expiration(id2):
-    loggedIn = id2loginDate[id2]
+def expiration(session):
+    loggedIn = session.loginDate
     now = datetime.now()
     diff = int((now - loggedIn).total_seconds())
     # print("diff", diff) # test exoiration
     # if diff % 5 == 0:
     #     return "SOON"
     diff = diff / (24 * 60 * 60)
-    if diff < 12:
+    if diff < LOGIN_OK_DAYS:
         return "OK"
-    if diff < 24:
+    if diff < LOGIN_MAX_DAYS:
         return "SOON"
     return None
 
@@ -83,10 +197,11 @@ def verifyToken(token, mustBeAdmin):
     tokenJS = json.JSONDecoder().decode(tokenS)
     id2 = tokenJS["id"]
     nowS = tokenJS["now"]
-    sharedkey = id2sharedKey.get(id2)
-    if sharedkey is None:
+    session = sessionStore.get(id2)
+    if session is None:
         return None, None
-    username = id2username.get(id2)
+    sharedkey = session.sharedKey
+    username = session.username
     if username is None:
         return None, None
     if mustBeAdmin and username != "admin":
@@ -107,7 +222,7 @@ def verifyToken(token, mustBeAdmin):
     clntNow = datetime.utcfromtimestamp(int(nowS) / 1000)
     diff = int((now - clntNow).total_seconds())
     if -600 < diff < 600: # clntNow within 10 minutes before or after now
-        return expiration(id2), username
+        return expiration(session), username
     return None, None
 
 
@@ -135,36 +250,364 @@ def checkToken(**_):  # check if token is still valid
     return jsonify({"token":"ok"})
 
 
+def rowColumns(dbtable):
+    # the spatial keys and changed are internal, clients get the columns they always got
+    return [col for col in dbtable.columns if col.name not in INTERNAL_COLUMNS]
+
+
+def streamRows(sel, parms):
+    # reads the result from a server side cursor in batches and sends it as a chunked JSON array
+    def generate():
+        with db.engine.connect() as conn:
+            r = conn.execution_options(stream_results=True).execute(sel, parms)
+            yield "["
+            sep = ""
+            while True:
+                rows = r.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                yield sep + json.dumps([list(row) for row in rows], cls=DecEncoder, separators=(",", ":"))[1:-1]
+                sep = ","
+            yield "]\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def rowsResponse(fmt, columns, rows):
+    # fmt from rowformat.negotiate, JSON unless the client asked for a columnar format
+    if fmt == rowformat.JSON:
+        resp = jsonify([list(row) for row in rows])
+    else:
+        resp = Response(rowformat.encode(fmt, columns, rows, DecEncoder().default), mimetype=fmt)
+    resp.vary.add("Accept")
+    return resp
+
+
+def pageRequest(dbtable):
+    # (limit, primary key names, key after which the page starts) for ?limit= and ?cursor=, limit is None
+    # without paging. Raises ValueError for a bad limit or cursor.
+    limitS = request.args.get("limit")
+    cursor = request.args.get("cursor")
+    if limitS is None and cursor is None:
+        return None, None, None
+    limit = PAGE_SIZE_MAX if limitS is None else min(max(int(limitS), 1), PAGE_SIZE_MAX)
+    names = [col.name for col in dbtable.primary_key.columns]
+    if len(names) == 0:
+        raise ValueError("table has no primary key")
+    key = None if cursor is None or cursor == "" else paging.decodeCursor(cursor, len(names))
+    return limit, names, key
+
+
+def pageResponse(fmt, columns, rows, limit, names):
+    # rows holds up to limit + 1 rows, the extra one only tells that there is a next page
+    resp = rowsResponse(fmt, columns, rows[:limit])
+    if len(rows) > limit:
+        colNames = [col.name for col in columns]
+        last = rows[limit - 1]
+        resp.headers["X-Next-Cursor"] = paging.encodeCursor(last[colNames.index(name)] for name in names)
+    return resp
+
+
 @app.route("/table/<tablename>")
 def table(tablename):
     dbtable = dbtables[tablename]
-    sel = dbtable.select()
+    columns = rowColumns(dbtable)
+    sel = sqlalchemy.select(columns)
+    fmt = rowformat.negotiate(request.accept_mimetypes)
+    try:
+        (limit, names, key) = pageRequest(dbtable)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    if limit is not None:
+        preparer = db.engine.dialect.identifier_preparer
+        parms = {}
+        if key is not None:
+            (where, parms) = paging.keyAfter([preparer.quote(name) for name in names], key)
+            sel = sel.where(db.text(where))
+        sel = sel.order_by(*[dbtable.c[name] for name in names]).limit(limit + 1)
+        with db.engine.connect() as conn:
+            rows = conn.execute(sel, parms).fetchall()
+        return pageResponse(fmt, columns, rows, limit, names)
+    if request.args.get("stream") == "true" and fmt == rowformat.JSON:  # columnar needs all rows first
+        return streamRows(sel, {})
     with db.engine.connect() as conn:
         r = conn.execute(sel)
         rows = r.fetchall()
-    jj = jsonify([list(row) for row in rows])
-    return jj
+    return rowsResponse(fmt, columns, rows)
+
+
+def regionCacheUsed():
+    # the cache is invalidated only in the process that wrote, and expires after REGION_CACHE_TTL
+    # for other writers, see regioncache.py. Across WSGI processes that would be too late.
+    return not request.environ.get("wsgi.multiprocess", False)
+
+
+def cachedRegion(tablename, cols, bounds, region2):
+    # the rows of /region from regionCache, reading only the tiles not cached yet; None for too big viewports
+    tiles = regionCache.tiles(*bounds)
+    if tiles is None:
+        return None
+    (found, generation) = regionCache.lookup(tablename, region2, tiles)
+    missing = [tile for tile in tiles if tile not in found]
+    metrics.regionCacheTiles.inc(("hit",), len(tiles) - len(missing))
+    if len(missing) > 0:
+        metrics.regionCacheTiles.inc(("miss",), len(missing))
+        rows = [r for (r, _) in missing]
+        colsOfRows = [c for (_, c) in missing]
+        where, parms = spatial.intFilter(*spatial.cellBounds(min(rows), max(rows), min(colsOfRows), max(colsOfRows)))
+        sel = "SELECT lat_int, lon_int, " + cols + " FROM " + tablename + " WHERE " + where
+        if region2 != "":
+            sel += " and region = :region"
+            parms["region"] = region2
+        with db.engine.connect() as conn:
+            rows = conn.execute(db.text(sel), parms).fetchall()
+        tileRows = {tile: [] for tile in missing}
+        for row in rows:
+            tile = (spatial.gridRow(row[0]), spatial.gridCol(row[1]))
+            if tile in tileRows:
+                tileRows[tile].append((row[0], row[1], tuple(row)[2:]))
+        regionCache.store(tablename, region2, generation, tileRows)
+        found.update(tileRows)
+    (minLat, maxLat, minLon, maxLon) = bounds
+    return [row for tile in tiles for (latInt, lonInt, row) in found[tile]
+            if minLat <= latInt <= maxLat and minLon <= lonInt <= maxLon]
+
+
+def bboxArgs():
+    # (minlat, maxlat, minlon, maxlon) of the request, and as scaled by spatial.bbox; None if one is missing.
+    # ValueError if one is not a number.
+    args = tuple(request.args.get(name) for name in ("minlat", "maxlat", "minlon", "maxlon"))
+    if None in args:
+        return None
+    return args, spatial.bbox(*args)
+
+
+def regionSelect(tablename, dbtable, cols, box, region2):
+    (args, bounds) = box
+    if spatial.hasKeys(dbtable):
+        where, parms = spatial.intFilter(*bounds)
+    else:  # table not yet migrated by MySqlCreateTables.addSpatialColumns
+        where = "lat_round <= :maxlat and lat_round >= :minlat and lon_round <= :maxlon and lon_round >= :minlon"
+        parms = dict(zip(("minlat", "maxlat", "minlon", "maxlon"), args))
+    sel = "SELECT " + cols + " FROM " + tablename + " WHERE " + where
+    if region2 is not None and region2 != "":
+        sel += " and region = :region"
+        parms["region"] = region2
+    return sel, parms
 
 
 @app.route("/region/<tablename>")
 @tokencheck(False)
 def region(tablename, **_):
-    minlat = request.args.get("minlat")
-    maxlat = request.args.get("maxlat")
-    minlon = request.args.get("minlon")
-    maxlon = request.args.get("maxlon")
     region2 = request.args.get("region")
+    dbtable = dbtables[tablename]
+    try:
+        box = bboxArgs()
+    except ValueError as e:
+        return make_response(str(e), 400)
+    if box is None:
+        return jsonify([])
+    preparer = db.engine.dialect.identifier_preparer
+    columns = rowColumns(dbtable)
+    cols = ", ".join(preparer.quote(col.name) for col in columns)
+    fmt = rowformat.negotiate(request.accept_mimetypes)
+    try:
+        (limit, names, key) = pageRequest(dbtable)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    stream = request.args.get("stream") == "true" and fmt == rowformat.JSON and limit is None
+    if spatial.hasKeys(dbtable) and not stream and limit is None and regionCacheUsed():
+        rows = cachedRegion(tablename, cols, box[1], region2 or "")
+        if rows is not None:
+            return rowsResponse(fmt, columns, rows)
+    (sel, parms) = regionSelect(tablename, dbtable, cols, box, region2)
+    if limit is not None:
+        quoted = [preparer.quote(name) for name in names]
+        if key is not None:
+            (where, keyParms) = paging.keyAfter(quoted, key)
+            sel += " and " + where
+            parms.update(keyParms)
+        sel += " ORDER BY " + ", ".join(quoted) + " LIMIT " + str(limit + 1)
+    # print(sel)
+    sel = db.text(sel)
+    if limit is not None:
+        with db.engine.connect() as conn:
+            rows = conn.execute(sel, parms).fetchall()
+        return pageResponse(fmt, columns, rows, limit, names)
+    if stream:
+        return streamRows(sel, parms)
     with db.engine.connect() as conn:
-        sel = "SELECT * FROM " + tablename + \
-              " WHERE lat_round <= :maxlat and lat_round >= :minlat and lon_round <= :maxlon and lon_round >= :minlon"
-        if region2 is not None and region2 != "":
-            sel += " and region = :region"
-        # print(sel)
-        sel = db.text(sel)
-        parms = {"minlat": minlat, "maxlat": maxlat, "minlon": minlon, "maxlon": maxlon, "region": region2}
-        rows = conn.execute(sel, parms)
-    jj = jsonify([list(row) for row in rows])
-    return jj
+        rows = conn.execute(sel, parms).fetchall()
+    return rowsResponse(fmt, columns, rows)
+
+
+@app.route("/regionall/<tablebase>")
+@tokencheck(False)
+def regionAll(tablebase, **_):
+    # the rows of _daten, _images and _zusatz in the bbox, read in one transaction and grouped by position:
+    # {"<lat_round>,<lon_round>": {"daten": [row, ...], "images": [...], "zusatz": [...]}, ...}
+    region2 = request.args.get("region")
+    try:
+        box = bboxArgs()
+    except ValueError as e:
+        return make_response(str(e), 400)
+    if box is None:
+        return jsonify({})
+    preparer = db.engine.dialect.identifier_preparer
+    res = {}
+    with db.engine.connect() as conn:
+        with conn.begin():  # one snapshot for all three tables
+            for table2 in ["daten", "images", "zusatz"]:
+                tablename = tablebase + "_" + table2
+                if tablename not in dbtables:
+                    continue
+                dbtable = dbtables[tablename]
+                columns = rowColumns(dbtable)
+                names = [col.name for col in columns]
+                (latIdx, lonIdx) = (names.index("lat_round"), names.index("lon_round"))
+                cols = ", ".join(preparer.quote(name) for name in names)
+                (sel, parms) = regionSelect(tablename, dbtable, cols, box, region2)
+                for row in conn.execute(db.text(sel), parms):
+                    loc = res.setdefault(row[latIdx] + "," + row[lonIdx], {})
+                    loc.setdefault(table2, []).append(list(row))
+    return jsonify(res)
+
+
+@app.route("/clusters/<tablename>")
+@tokencheck(False)
+def clusters(tablename, **_):
+    # count and centroid of the rows per cell of a zoom dependent grid, for overview maps:
+    # [{"lat": .., "lon": .., "count": n}, ...], with ?groupby=<column> one entry per cell and value of the column
+    region2 = request.args.get("region")
+    groupBy = request.args.get("groupby")
+    dbtable = dbtables[tablename]
+    try:
+        box = bboxArgs()
+    except ValueError as e:
+        return make_response(str(e), 400)
+    if box is None:
+        return jsonify([])
+    try:
+        zoom = int(request.args.get("zoom", ""))
+    except ValueError:
+        return make_response("zoom missing", 400)
+    if not 0 <= zoom <= MAX_ZOOM:
+        return make_response("zoom must be between 0 and " + str(MAX_ZOOM), 400)
+    if groupBy is not None and (groupBy not in dbtable.c or groupBy in INTERNAL_COLUMNS or
+                                groupBy in ("lat", "lon", "lat_round", "lon_round", "created", "modified")):
+        return make_response("cannot group by " + groupBy, 400)
+    # grid step in degrees * SCALE, as float so that the division is not an integer division in sqlite
+    step = float(max(360 * spatial.SCALE * CLUSTER_PIXELS // (256 << zoom), 1))
+    preparer = db.engine.dialect.identifier_preparer
+    if spatial.hasKeys(dbtable):
+        (latExpr, lonExpr) = ("lat_int", "lon_int")
+    else:
+        (latExpr, lonExpr) = ("lat * " + str(spatial.SCALE), "lon * " + str(spatial.SCALE))
+    keys = ["FLOOR(" + latExpr + " / :step)", "FLOOR(" + lonExpr + " / :step)"]
+    if groupBy is not None:
+        keys.append(preparer.quote(groupBy))
+    (sel, parms) = regionSelect(tablename, dbtable, "count(*), avg(lat), avg(lon)" +
+                                ("" if groupBy is None else ", " + preparer.quote(groupBy)),
+                                box, region2)
+    sel += " GROUP BY " + ", ".join(keys)
+    parms["step"] = step
+    res = []
+    with db.engine.connect() as conn:
+        for row in conn.execute(db.text(sel), parms):
+            cluster = {"count": row[0], "lat": float(row[1]), "lon": float(row[2])}
+            if groupBy is not None:
+                cluster["value"] = row[3]
+            res.append(cluster)
+    return jsonify(res)
+
+
+def positionCell(lat_round, lon_round):
+    return spatial.addKeys({"lat_round": lat_round, "lon_round": lon_round})["cell"]
+
+
+def replacedCells(conn, dbtable, rows):
+    # the cells of the rows an upsert may replace at another position, because their key does not contain
+    # the position (image_path of _images, nr of _zusatz). None if that cannot be found out.
+    cells = set()
+    for key in upsert.uniqueKeys(dbtable):
+        if "lat_round" in key and "lon_round" in key:
+            continue
+        if len(key) != 1:
+            return None
+        values = [row[key[0]] for row in rows if row.get(key[0]) is not None]
+        for i in range(0, len(values), upsert.BATCH_SIZE):
+            sel = sqlalchemy.select([dbtable.c.cell]).where(dbtable.c[key[0]].in_(values[i:i + upsert.BATCH_SIZE]))
+            cells.update(r[0] for r in conn.execute(sel.distinct()) if r[0] is not None)
+    return cells
+
+
+def dbNow(conn):
+    # the clock of the changed columns, which /changes and the tombstones must use as well
+    if db.engine.dialect.name == "mysql":
+        return conn.execute(db.text("SELECT NOW()")).scalar()
+    return datetime.now()
+
+
+def tombstone(conn, tablename, keys):
+    # remember deleted rows for /changes, keys are the columns the DELETE matched on.
+    # Tombstones older than TOMBSTONE_DAYS of the table are dropped meanwhile.
+    if "tombstones" not in dbtables:
+        return
+    now = dbNow(conn)
+    tombstones = dbtables["tombstones"]
+    row = dict(keys)
+    row["tablename"] = tablename
+    row["deleted"] = now
+    conn.execute(tombstones.insert(), row)
+    conn.execute(tombstones.delete().where(tombstones.c.tablename == tablename)
+                 .where(tombstones.c.deleted < now - timedelta(days=TOMBSTONE_DAYS)))
+
+
+@app.route("/changes/<tablebase>")
+@tokencheck(False)
+def changes(tablebase, **_):
+    # rows changed after since, and the rows deleted after since. Apply "deleted" before the rows.
+    # Rows are selected by the server time in their changed column, not by modified or created, which are
+    # set by the clients: an offline client may upload edits with times before the last until of another.
+    # until lags CHANGES_LAG behind, so that rows of transactions running now are returned next time as well.
+    # Tombstones are kept TOMBSTONE_DAYS: with an older since, "resync" is true, and the client has to load
+    # its tables anew (e.g. with /regionall), as it may have missed deletions.
+    sinceS = request.args.get("since")
+    since = datetime(1970, 1, 1) if sinceS is None or sinceS == "" else datetime.strptime(sinceS, DATE_FORMAT)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.connect() as conn:
+        now = dbNow(conn)
+        until = now - timedelta(seconds=CHANGES_LAG)
+        res = {"since": since, "until": until,
+               "resync": sinceS not in (None, "") and since < now - timedelta(days=TOMBSTONE_DAYS)}
+        for (table2, modCol) in [("daten", "modified"), ("images", "created"), ("zusatz", "modified")]:
+            tablename = tablebase + "_" + table2
+            if tablename not in dbtables:
+                continue
+            if upsert.CHANGED_COLUMN in dbtables[tablename].c:  # else not migrated yet
+                modCol = upsert.CHANGED_COLUMN
+            cols = ", ".join(preparer.quote(col.name) for col in rowColumns(dbtables[tablename]))
+            sel = db.text("SELECT " + cols + " FROM " + tablename + " WHERE " + modCol + " > :since")
+            rows = conn.execute(sel, {"since": since}).fetchall()
+            res[table2] = [list(row) for row in rows]
+        deleted = []
+        if "tombstones" in dbtables:
+            sel = db.text("SELECT * FROM tombstones WHERE tablename IN (:daten, :images, :zusatz) "
+                          "AND deleted > :since ORDER BY deleted")
+            parms = {"daten": tablebase + "_daten", "images": tablebase + "_images",
+                     "zusatz": tablebase + "_zusatz", "since": since}
+            for row in conn.execute(sel, parms).fetchall():
+                ts = {k: v for (k, v) in row.items() if v is not None}
+                ts["table"] = ts.pop("tablename")[len(tablebase) + 1:]
+                deleted.append(ts)
+        res["deleted"] = deleted
+    return jsonify(res)
+
+
+@app.route("/metrics")
+@tokencheck(True)
+def getMetrics(**_):
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/tables")
@@ -172,6 +615,28 @@ def tables():
     return jsonify([str(tablename) for tablename in dbtables.keys()])
 
 
+def upsertRows(conn, dbtable, rows):
+    # upsert with the spatial keys, returns the counts and lastrowid of upsert.upsert, and the cells
+    # to invalidate in the region cache, None for the whole table
+    cells = None
+    if spatial.hasKeys(dbtable):
+        for row in rows:
+            spatial.addKeys(row)
+        if regionCacheUsed():
+            cells = replacedCells(conn, dbtable, rows)
+            if cells is not None:
+                cells.update(row["cell"] for row in rows)
+    (batches, rowid) = upsert.upsert(conn, dbtable, rows)
+    return batches, rowid, cells
+
+
+def invalidateRegions(tablename, cells):
+    if cells is None:
+        regionCache.invalidateTable(tablename)
+    else:
+        regionCache.invalidate(tablename, cells)
+
+
 @app.route("/add/<tablename>", methods=['POST'])
 @tokencheck(False)
 def addRow(tablename, username=None):
@@ -181,65 +646,117 @@ def addRow(tablename, username=None):
         for row in jlist:
             row["creator"] = username
     dbtable = dbtables[tablename]
-    ins = dbtable.insert()
-    with db.engine.connect() as conn:
-        # try to achieve what sqlite does with "on conflict replace"
-        for retries in range(2):
-            try:
-                r = conn.execute(ins, jlist)
-                break
-            except IntegrityError as e:
-                if retries == 0:
-                    nrRows = 0
-                    for jrow in jlist:
-                        if tablename.endswith("_daten"):
-                            # PRIMARY KEY(lat_round, lon_round)
-                            creator = jrow["creator"]
-                            lat_round = jrow["lat_round"]
-                            lon_round = jrow["lon_round"]
-                            delStmt = db.text("DELETE FROM " + tablename +
-                                              " WHERE creator = :creator and lat_round = :lat_round and lon_round = "
-                                              ":lon_round")
-                            parms = {"creator": creator, "lat_round": lat_round, "lon_round": lon_round}
-                        elif tablename.endswith("_images"):
-                            # PRIMARY KEY(image_path)
-                            image_path = jrow["image_path"]
-                            delStmt = db.text("DELETE FROM " + tablename +
-                                              " WHERE image_path = :image_path")
-                            parms = {"image_path": image_path}
-                        elif tablename.endswith("_zusatz"):
-                            err = str(e)
-                            if err.index("'PRIMARY'") > 0:
-                                # primary key pk
-                                nr = jrow["nr"]
-                                delStmt = db.text("DELETE FROM " + tablename +
-                                                  " WHERE nr = :nr")
-                                parms = {"nr": nr}
-                            else:
-                                # UNIQUE(creator, created, modified, lat_round, lon_round)
-                                creator = jrow["creator"]
-                                created = jrow["created"]
-                                modified = jrow["modified"]
-                                lat_round = jrow["lat_round"]
-                                lon_round = jrow["lon_round"]
-                                delStmt = db.text("DELETE FROM " + tablename +
-                                                  " WHERE creator = :creator and created = :created and "
-                                                  "modified = :modified and lat_round = :lat_round and lon_round = "
-                                                  ":lon_round")
-                                parms = {"creator": creator, "created": created, "modified": modified,
-                                         "lat_round": lat_round, "lon_round": lon_round}
-                        else:
-                            raise ValueError("Unbekannter Tabellenname " + tablename)
-                        r = conn.execute(delStmt, parms)
-                        nrRows += r.rowcount
-                    print("rows deleted from " + tablename + ": " + str(nrRows))
-                    continue
-                else:
-                    print("addRow exception", e)
-                    raise e
-        print("rows inserted into " + tablename + ": " + str(r.rowcount))
-        resp = jsonify({tablename: r.rowcount, "rowid": r.lastrowid})
-        return resp
+    with db.engine.begin() as conn:
+        (batches, rowid, cells) = upsertRows(conn, dbtable, jlist)
+    invalidateRegions(tablename, cells)
+    inserted = sum(ins for (ins, _) in batches)
+    updated = sum(upd for (_, upd) in batches)
+    print("rows inserted into " + tablename + ": " + str(inserted) + ", updated: " + str(updated))
+    resp = jsonify({tablename: len(jlist), "rowid": rowid, "inserted": inserted, "updated": updated,
+                    "batches": [{"inserted": ins, "updated": upd} for (ins, upd) in batches]})
+    return resp
+
+
+def syncRowError(dbtable, row):
+    # why a row of /sync cannot be stored, or None
+    if not isinstance(row, dict):
+        return "not an object"
+    unknown = [k for k in row if k not in dbtable.c or k in INTERNAL_COLUMNS]
+    if len(unknown) > 0:
+        return "unknown columns: " + ", ".join(unknown)
+    missing = [col.name for col in dbtable.columns
+               if not col.nullable and col.server_default is None and col.name not in row
+               and col.name not in INTERNAL_COLUMNS and col.autoincrement is not True
+               and not (col.primary_key and col.name == "nr")]
+    if len(missing) > 0:
+        return "missing columns: " + ", ".join(missing)
+    return None
+
+
+@app.route("/sync/<tablebase>", methods=['POST'])
+@tokencheck(False)
+def sync(tablebase, username=None):
+    # the edits of an offline session in one request and one transaction:
+    # {"daten": [rows], "images": [rows], "zusatz": [rows], "imagerefs": [{"name": .., "sha256": ..}]}
+    # Rows are stored as by /add, all or none: if one row is invalid, nothing is stored, the status is 400,
+    # and the response has the error of each item. Image refs link an image already stored under that
+    # sha256 (see /addimage with x-sha256), after the commit. "stored": false means that the image must
+    # still be uploaded with /addimage.
+    jreq = request.json
+    if not isinstance(jreq, dict):
+        return make_response("Expected a JSON object", 400)
+    res = {}
+    for key in ("daten", "images", "zusatz", "imagerefs"):
+        if not isinstance(jreq.get(key) or [], list):
+            res[key] = {"error": "list expected"}
+    failed = len(res) > 0
+    tables2 = [table2 for table2 in ("daten", "images", "zusatz") if table2 not in res and jreq.get(table2)]
+    refs = [] if "imagerefs" in res else jreq.get("imagerefs") or []
+    if sum(len(jreq[table2]) for table2 in tables2) + len(refs) > SYNC_MAX_ITEMS:
+        return make_response("Too many items", 413)
+    for table2 in tables2:
+        tablename = tablebase + "_" + table2
+        if username is not None and username != "admin":  # as in addRow, before the check of missing columns
+            for row in jreq[table2]:
+                if isinstance(row, dict):
+                    row["creator"] = username
+        if tablename not in dbtables:
+            errors = ["no table " + tablename] * len(jreq[table2])
+        else:
+            errors = [syncRowError(dbtables[tablename], row) for row in jreq[table2]]
+        res[table2] = {"items": [{"ok": True} if err is None else {"error": err} for err in errors]}
+        failed = failed or any(err is not None for err in errors)
+    refErrors = []
+    for ref in refs:
+        name = str(ref.get("name") or "") if isinstance(ref, dict) else ""
+        try:
+            digest = imagestore.parseDigest(str(ref.get("sha256", ""))) if isinstance(ref, dict) else None
+        except imagestore.BadDigest:
+            digest = None
+        if digest is None:
+            refErrors.append("sha256 expected")
+        elif not imagestore.validName(name):
+            refErrors.append("image name <lat>_<lon>_<yyyymmdd>... expected")
+        else:
+            refErrors.append(None)
+    if "imagerefs" not in res:
+        res["imagerefs"] = [{"ok": True} if err is None else {"error": err} for err in refErrors]
+    failed = failed or any(err is not None for err in refErrors)
+    if failed:
+        return make_response(jsonify(res), 400)
+
+    changed = []
+    with db.engine.begin() as conn:
+        for table2 in tables2:
+            dbtable = dbtables[tablebase + "_" + table2]
+            rows = jreq[table2]
+            # upsert.upsert takes the columns of the first row, so rows are grouped by their columns
+            groups = {}
+            for row in rows:
+                groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+            (inserted, updated) = (0, 0)
+            for group in groups.values():
+                (batches, _, cells) = upsertRows(conn, dbtable, group)
+                changed.append((dbtable.name, cells))
+                inserted += sum(ins for (ins, _) in batches)
+                updated += sum(upd for (_, upd) in batches)
+            res[table2]["inserted"] = inserted
+            res[table2]["updated"] = updated
+    for (tablename, cells) in changed:
+        invalidateRegions(tablename, cells)
+    for (ref, item) in zip(refs, res["imagerefs"]):
+        name = str(ref["name"])
+        item["url"] = request.url_root[0:-1] + url_for('getImage', tablebase=tablebase, path=name)
+        try:  # the rows are committed, a failed link only means that the image must be uploaded
+            item["stored"] = imagestore.linkExisting(tablebase, name, str(ref["sha256"]).lower())
+        except OSError as e:
+            utils.printEx("sync: linking " + name + " failed", e)
+            item["stored"] = False
+        if item["stored"]:
+            postProcessor.submit(tablebase, name)
+    print("sync " + tablebase + ": " + ", ".join(table2 + " " + str(len(jreq[table2])) for table2 in tables2) +
+          ", imagerefs " + str(len(refs)))
+    return jsonify(res)
 
 
 @app.route("/official/<tablename>", methods=['POST'])
@@ -255,9 +772,14 @@ def official(tablename, **_):
         parms = {"lat_round": lat_round, "lon_round": lon_round}
         r = conn.execute(delStmt, parms)
         print("official deleted " + str(r.rowcount))
+        if r.rowcount > 0:
+            tombstone(conn, tablename, parms)
+        if spatial.hasKeys(dbtable):
+            spatial.addKeys(jrow)
         ins = dbtable.insert()
         r = conn.execute(ins, jrow)
         print("official inserted " + str(r.rowcount))
+    regionCache.invalidate(tablename, [positionCell(lat_round, lon_round)])
     return jsonify({tablename: r.rowcount})
 
 
@@ -277,7 +799,12 @@ def deleteLoc(tablebase, **_):
                               " WHERE lat_round = :lat_round and lon_round = :lon_round")
             parms = {"lat_round": lat_round, "lon_round": lon_round}
             r = conn.execute(delStmt, parms)
+            if r.rowcount > 0:
+                tombstone(conn, tablebase + "_" + table2, parms)
             res[table2] = r.rowcount
+    for table2 in tables2:
+        if res[table2] > 0:
+            regionCache.invalidate(tablebase + "_" + table2, [positionCell(lat_round, lon_round)])
     return jsonify(res)
 
 
@@ -287,25 +814,25 @@ def getImage(tablebase, path):
         tablebase = tablebase[0:-7]
     maxdim = request.args.get("maxdim")
     maxdim = 0 if maxdim is None else int(maxdim)
-    datum = path.split("_")[2]  # 20200708
-    yr = datum[0:4]
-    mo = datum[4:6]
-    dy = datum[6:8]
-    path = os.path.join("images", tablebase, yr, mo, dy, path)
-    img = Image.open(path)
-    iw = img.width
-    ih = img.height
-    if maxdim != 0:
-        xw = iw / maxdim
-        xh = ih / maxdim
-        x = xh if xw < xh else xw
-        w = int(iw / x)
-        h = int(ih / x)
-        img = img.resize(size=(w, h))
-    buf = io.BytesIO()
-    img.save(buf, format="jpeg")
-    resp = make_response(buf.getvalue())
-    resp.mimetype = "image/jpeg"
+    srcPath = imagestore.imagePath(tablebase, path)
+    if maxdim == 0:
+        # the original as uploaded, via wsgi.file_wrapper (sendfile) or X-Sendfile, with Range support.
+        # The ETag is ours, not the one of send_file, so that asgi.py can send the same.
+        mimetype = mimetypes.guess_type(path)[0] or "image/jpeg"
+        st = os.stat(srcPath)
+        resp = send_file(os.path.abspath(srcPath), mimetype=mimetype, conditional=False, add_etags=False)
+        resp.set_etag(imagestore.fileEtag(st))
+        return resp.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+    st = os.stat(srcPath)
+    etag = imageCache.etag(tablebase, path, maxdim, st.st_mtime_ns)
+    lastModified = datetime.utcfromtimestamp(int(st.st_mtime))
+    if not is_resource_modified(request.environ, etag=etag, last_modified=lastModified):
+        resp = make_response("", 304)
+    else:
+        f = imageCache.open(tablebase, path, srcPath, maxdim, st.st_mtime_ns)
+        resp = send_file(f, mimetype="image/jpeg", add_etags=False)
+    resp.set_etag(etag)
+    resp.last_modified = lastModified
     return resp
 
 
@@ -314,12 +841,9 @@ def getImage(tablebase, path):
 def deleteImage(tablebase, path, **_):
     if tablebase.endswith("_images"):
         tablebase = tablebase[0:-7]
-    datum = path.split("_")[2]  # 20200708
-    yr = datum[0:4]
-    mo = datum[4:6]
-    dy = datum[6:8]
-    path = os.path.join("images", tablebase, yr, mo, dy, path)
-    os.remove(path)
+    if not imagestore.validName(path):
+        return make_response("Invalid image name", 400)
+    imagestore.remove(tablebase, path)  # also if it is gone already, e.g. discarded as invalid
     return jsonify({})
 
 
@@ -328,28 +852,48 @@ def deleteImage(tablebase, path, **_):
 def addImage(tablebase, imgname, **_):
     if tablebase.endswith("_images"):
         tablebase = tablebase[0:-7]
-    datum = imgname.split("_")[2]  # 20200708
-    yr = datum[0:4]
-    mo = datum[4:6]
-    dy = datum[6:8]
-    data = request.get_data(cache=False)
-    path = os.path.join("images", tablebase, yr, mo, dy)
-    os.makedirs(path, exist_ok=True)
-    path = os.path.join(path, imgname)
-    with open(path, mode='wb') as imgfile:
-        imgfile.write(data)
-    imgurl = request.url_root[0:-1] + url_for('getimage', tablebase=tablebase, path=path)
-    return jsonify({"url": imgurl})
+    if not imagestore.validName(imgname):
+        return make_response("Invalid image name", 400)
+    if request.content_length is not None and request.content_length > MAX_IMAGE_SIZE:
+        return make_response("Image too large", 413)
+    imgurl = request.url_root[0:-1] + url_for('getImage', tablebase=tablebase, path=imgname)
+    try:
+        digest = imagestore.parseDigest(request.headers.get("x-sha256"))
+    except imagestore.BadDigest as e:
+        return make_response(str(e), 400)
+    # the body is not read, with "Expect: 100-continue" the client does not even send it
+    if digest is not None and imagestore.linkExisting(tablebase, imgname, digest):
+        return jsonify(imageAdded(tablebase, imgname, imgurl, digest, False))
+    with imagestore.Upload(tablebase, imgname, MAX_IMAGE_SIZE, digest) as upload:
+        try:
+            while True:
+                chunk = request.stream.read(imagestore.CHUNK_SIZE)
+                if not chunk:
+                    break
+                upload.write(chunk)
+            upload.commit()
+        except imagestore.TooLarge:
+            return make_response("Image too large", 413)
+        except imagestore.BadDigest as e:
+            return make_response(str(e), 400)
+    return jsonify(imageAdded(tablebase, imgname, imgurl, upload.digest, upload.stored))
+
+
+def imageAdded(tablebase, imgname, imgurl, digest, stored):
+    # the thumbnails and the response of /addimage, here and in asgi.py
+    postProcessor.submit(tablebase, imgname)
+    return {"url": imgurl, "sha256": digest, "stored": stored}
 
 
 @app.route("/addconfig", methods=['POST'])
 @tokencheck(True)
 def addConfig(**_):
-    baseConfig = config.Config()
+    baseConfig = config.getRegistry()
+    baseConfig.refresh()
     data = request.get_data(cache=False)
-    confJS = baseConfig.checkConfig(io.BytesIO(data))
+    (confJS, errors) = baseConfig.checkConfig(io.BytesIO(data))
     if confJS is None:
-        return jsonify("Error", baseConfig.errors)
+        return jsonify("Error", errors)
     name = utils.normalize(confJS["name"])
     if name is None or name == "" or len(name) > 100:
         return jsonify("Error", "invalid name:" + str(name))
@@ -357,24 +901,54 @@ def addConfig(**_):
     path = os.path.join("config", nameVers + ".json")
     if os.path.exists(path):
         return jsonify("Error", "File " + os.path.abspath(path) + " already exists")
+    # ?online=true copies big tables in chunks instead of ALTERing them in place, see onlineMigration.py
+    online = request.args.get("online", "false") == "true"
     db2 = MySqlCreateTables()
-    db2.updateDB(confJS, baseConfig.getBaseVersions(name))
+    db2.updateDB(confJS, baseConfig.getBaseVersions(name), online)
+    tablename = confJS["db_tabellenname"]
+    dbtables.invalidate([tablename + "_daten", tablename + "_images", tablename + "_zusatz", "tombstones"])
+    for table2 in ["_daten", "_images", "_zusatz"]:
+        regionCache.invalidateTable(tablename + table2)
     with open(path, mode='wb') as configFile:
         configFile.write(data)
-    baseConfig.addConfig(confJS)
+    baseConfig.refresh()
+    fileCache.invalidate(("configs",))
+    fileCache.invalidate(("config", nameVers + ".json"))
     return jsonify({"name": name})
 
 
+def cachedResponse(key, path, build, mimetype):
+    # answers If-None-Match with 304, also for the etags that compressResponse gave the compressed variants
+    (body, etag) = fileCache.get(key, path, build)
+    for suffix in ["", "-gzip", "-br"]:
+        if request.if_none_match.contains(etag + suffix):
+            resp = Response(status=304)
+            resp.set_etag(etag + suffix)
+            return resp
+    resp = Response(body, mimetype=mimetype)
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True  # clients may keep it, but must revalidate
+    return resp
+
+
 @app.route("/configs")
 def getConfigs():
-    return jsonify(sorted(os.listdir("config")))
+    return cachedResponse(("configs",), "config",
+                          lambda: json.dumps(sorted(os.listdir("config"))).encode("utf-8"), "application/json")
 
 
 @app.route("/config/<name>")
 def getConfig(name):
     path = os.path.join("config", name)
-    with open(path, "r", encoding="UTF-8") as jsonFile:
-        return json.load(jsonFile)
+
+    def build():
+        confJS = config.getRegistry().getFile(name)
+        if confJS is None:
+            with open(path, "r", encoding="UTF-8") as jsonFile:
+                confJS = json.load(jsonFile)
+        return json.dumps(confJS).encode("utf-8")
+
+    return cachedResponse(("config", name), path, build, "application/json")
 
 
 @app.route("/markercodes/<tablebase>")
@@ -382,17 +956,24 @@ def getMarkerCodes(tablebase):
     path = os.path.join("markercodes", tablebase)
     if not os.path.exists(path):
         return jsonify([])
-    filenames = sorted(os.listdir(path))
-    filenames = [filename[0:-5] for filename in filenames if filename.endswith(".json")]
-    return jsonify(filenames)
+
+    def build():
+        filenames = sorted(os.listdir(path))
+        filenames = [filename[0:-5] for filename in filenames if filename.endswith(".json")]
+        return json.dumps(filenames).encode("utf-8")
+
+    return cachedResponse(("markercodes", tablebase), path, build, "application/json")
 
 
 @app.route("/markercode/<tablebase>/<name>")
 def getMarkerCode(tablebase, name):
     path = os.path.join("markercodes", tablebase, name + ".json")
-    with open(path, "r", encoding="UTF-8") as f:
-        codeJS = f.read()
-        return codeJS
+
+    def build():
+        with open(path, "rb") as f:
+            return f.read()
+
+    return cachedResponse(("markercode", tablebase, name), path, build, "text/html")
 
 
 @app.route("/addmarkercode/<tablebase>/<name>", methods=['POST'])
@@ -407,6 +988,8 @@ def addMarkerCode(tablebase, name, **_):
     path = os.path.join(path, name + ".json")
     with open(path, mode='wb') as markerCodeFile:
         markerCodeFile.write(data)
+    fileCache.invalidate(("markercode", tablebase, name))
+    fileCache.invalidate(("markercodes", tablebase))
     return jsonify({"name": name})
 
 
@@ -415,6 +998,8 @@ def addMarkerCode(tablebase, name, **_):
 def deleteMarkerCode(tablebase, name, **_):
     path = os.path.join("markercodes", tablebase, name + ".json")
     os.remove(path)
+    fileCache.invalidate(("markercode", tablebase, name))
+    fileCache.invalidate(("markercodes", tablebase))
     return jsonify({})
 
 
@@ -424,13 +1009,9 @@ def kex():  # Diffie Hellman key exchange X25519
     pubBytes = base64.b64decode(data["pubkey"])
     id2 = data["id"]
     his_pubkey = X25519PublicKey.from_public_bytes(pubBytes)
-    my_privkey = X25519PrivateKey.generate()
-    my_pubkey = my_privkey.public_key()
+    (my_privkey, my_pkS) = keyPool.take()  # used for this exchange only
     sharedkey = my_privkey.exchange(his_pubkey)
-    id2sharedKey[id2] = sharedkey
-    my_pkbytes = my_pubkey.public_bytes(encoding=serialization.Encoding.Raw,
-                                        format=serialization.PublicFormat.Raw)
-    my_pkS = base64.b64encode(my_pkbytes).decode("utf-8")
+    sessionStore.setKey(id2, sharedkey)
     return jsonify({"pubkey": my_pkS})
 
 
@@ -440,7 +1021,7 @@ def test():
     id2 = data["id"]
     encData = base64.b64decode(data["enc"])
     iv = base64.b64decode(data["iv"])
-    sharedkey = id2sharedKey[id2]
+    sharedkey = sessionStore.get(id2).sharedKey
     aesAlg = algorithms.AES(sharedkey)
     cipher = Cipher(aesAlg, modes.CBC(iv))
     decryptor = cipher.decryptor()
@@ -457,10 +1038,10 @@ def userFromDB(emailS):
         sel = "SELECT username, encpw FROM users WHERE email = :email"
         sel = db.text(sel)
         parms = {"email": emailS}
-        res = conn.execute(sel, parms)
-        if res.rowcount != 1:
+        rows = conn.execute(sel, parms).fetchall()  # rowcount of a SELECT is not known with every driver
+        if len(rows) != 1:
             return None, None
-        row = res.fetchone()
+        row = rows[0]
         username = row[0]
         encPWS = row[1]
         encPWB = base64.b64decode(encPWS)
@@ -481,8 +1062,7 @@ def dbContainsUsername(username):
         sel = "SELECT username FROM users WHERE username = :username"
         sel = db.text(sel)
         parms = {"username": username}
-        res = conn.execute(sel, parms)
-        return res.rowcount > 0
+        return conn.execute(sel, parms).first() is not None
 
 
 @app.route("/auth/<loginOrSignon>", methods=['POST'])
@@ -493,7 +1073,7 @@ def auth(loginOrSignon):
         id2 = data["id"]
         encData = base64.b64decode(data["ctxt"])
         iv = base64.b64decode(data["iv"])
-        sharedkey = id2sharedKey[id2]
+        sharedkey = sessionStore.get(id2).sharedKey
         aesAlg = algorithms.AES(sharedkey)
         cipher = Cipher(aesAlg, modes.CBC(iv))
         decryptor = cipher.decryptor()
@@ -530,8 +1110,7 @@ def auth(loginOrSignon):
                     resp = jsonify({"Auth error": "user name can not be changed"})
                     resp.status_code = http.HTTPStatus.UNAUTHORIZED
                     return resp
-        id2loginDate[id2] = datetime.now()
-        id2username[id2] = username
+        sessionStore.login(id2, username, datetime.now())
         return jsonify({"id": id2, "username": username})
     except Exception as ex:
         resp = jsonify({"error": str(ex)})
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import mimetypes
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from werkzeug.http import http_date, is_resource_modified
+
+import app
+import imagestore
+import metrics
+
+"""
+ASGI entry point, an alternative to app.py under mod_wsgi, e.g.
+  uvicorn asgi:application --host 0.0.0.0 --port 8080
+/addimage and /getimage are served here directly: request and response bodies are read and
+written asynchronously, only the file operations, the token check and PIL run in small
+thread pools. A slow mobile client therefore holds a coroutine, not a thread.
+The after_request hooks of app.py do not run for them: the metrics are recorded here, and
+compressResponse would not compress images anyway.
+All other routes go to the Flask app in app.py, on a pool of WSGI_THREADS threads, with the
+request body read completely before a thread is taken. Responses are handed from the thread
+to the event loop through a bounded queue.
+Run it as one process: the session store, the region cache and the image post processing
+are per process, see app.py.
+"""
+
+WSGI_THREADS = 5
+FILE_THREADS = 4  # token check, stat, open, read and write of image files
+IMAGE_THREADS = 2  # PIL, for derived images not in the image cache yet
+MAX_BODY_IN_MEMORY = (1024 * 1024)  # larger request bodies for the WSGI routes are spooled to a temp file
+QUEUE_CHUNKS = 8  # response chunks in flight between a WSGI thread and the event loop
+
+wsgiExecutor = ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix="wsgi")
+fileExecutor = ThreadPoolExecutor(FILE_THREADS, thread_name_prefix="file")
+imageExecutor = ThreadPoolExecutor(IMAGE_THREADS, thread_name_prefix="image")
+
+routes = [("POST", re.compile(r"/addimage/([^/]+)/([^/]+)"), "addImage"),
+          ("GET", re.compile(r"/getimage/([^/]+)/([^/]+)"), "getImage")]
+
+
+def run(executor, f, *args):
+    return asyncio.get_running_loop().run_in_executor(executor, f, *args)
+
+
+def headersOf(scope):
+    return {k.decode("latin-1").lower(): v.decode("latin-1") for (k, v) in scope["headers"]}
+
+
+async def respond(send, status, headers, body=b""):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(k.encode("latin-1"), str(v).encode("latin-1")) for (k, v) in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def respondJson(send, obj, headers):
+    body = (json.dumps(obj, sort_keys=True) + "\n").encode("utf-8")  # like jsonify
+    await respond(send, 200, [("Content-Type", "application/json"), ("Content-Length", len(body))] + headers, body)
+
+
+async def respondText(send, status, text, headers=()):
+    body = text.encode("utf-8")
+    await respond(send, status, [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", len(body))] +
+                  list(headers), body)
+
+
+async def sendFile(send, f, headers, head):
+    try:
+        size = os.fstat(f.fileno()).st_size
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(k.encode("latin-1"), str(v).encode("latin-1"))
+                                for (k, v) in headers + [("Content-Length", size)]]})
+        while not head:
+            chunk = await run(fileExecutor, f.read, imagestore.CHUNK_SIZE)
+            if not chunk:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        f.close()
+
+
+def baseUrl(scope, hdrs):
+    host = hdrs.get("host")
+    if host is None:
+        (host, port) = scope["server"]
+        host = host + ":" + str(port)
+    return scope.get("scheme", "http") + "://" + host + scope.get("root_path", "")
+
+
+async def addImage(scope, receive, send, tablebase, imgname):
+    hdrs = headersOf(scope)
+    (respHdr, _) = await run(fileExecutor, app.verifyToken, hdrs.get("x-auth"), False)  # like tokencheck(False)
+    if respHdr is None:
+        return await respondText(send, 401, "Auth error")
+    auth = [("x-auth", respHdr)]
+    if tablebase.endswith("_images"):
+        tablebase = tablebase[0:-7]
+    if not imagestore.validName(imgname):
+        return await respondText(send, 400, "Invalid image name", auth)
+    length = hdrs.get("content-length")
+    if length is not None and int(length) > app.MAX_IMAGE_SIZE:
+        return await respondText(send, 413, "Image too large", auth)
+    imgurl = baseUrl(scope, hdrs) + "/getimage/" + urllib.parse.quote(tablebase) + "/" + urllib.parse.quote(imgname)
+    try:
+        digest = imagestore.parseDigest(hdrs.get("x-sha256"))
+    except imagestore.BadDigest as e:
+        return await respondText(send, 400, str(e), auth)
+    if digest is not None and await run(fileExecutor, imagestore.linkExisting, tablebase, imgname, digest):
+        return await respondJson(send, app.imageAdded(tablebase, imgname, imgurl, digest, False), auth)
+    upload = await run(fileExecutor, imagestore.Upload, tablebase, imgname, app.MAX_IMAGE_SIZE, digest)
+    with upload:
+        try:
+            buf = bytearray()
+            more = True
+            while more:
+                msg = await receive()
+                if msg["type"] == "http.disconnect":
+                    return
+                buf += msg.get("body", b"")
+                more = msg.get("more_body", False)
+                if len(buf) >= imagestore.CHUNK_SIZE or not more:
+                    await run(fileExecutor, upload.write, bytes(buf))
+                    buf.clear()
+            await run(fileExecutor, upload.commit)
+        except imagestore.TooLarge:
+            return await respondText(send, 413, "Image too large", auth)
+        except imagestore.BadDigest as e:
+            return await respondText(send, 400, str(e), auth)
+    await respondJson(send, app.imageAdded(tablebase, imgname, imgurl, upload.digest, upload.stored), auth)
+
+
+async def getImage(scope, receive, send, tablebase, path):
+    hdrs = headersOf(scope)
+    if tablebase.endswith("_images"):
+        tablebase = tablebase[0:-7]
+    query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    maxdim = int(query["maxdim"][0]) if "maxdim" in query else 0
+    srcPath = imagestore.imagePath(tablebase, path)
+    try:
+        st = await run(fileExecutor, os.stat, srcPath)
+    except FileNotFoundError:
+        return await respondText(send, 404, "Not Found")
+    lastModified = datetime.utcfromtimestamp(int(st.st_mtime))
+    maxAge = int(app.app.send_file_max_age_default.total_seconds())
+    if maxdim == 0:
+        etag = imagestore.fileEtag(st)  # as in app.py
+        mimetype = mimetypes.guess_type(path)[0] or "image/jpeg"
+    else:
+        etag = app.imageCache.etag(tablebase, path, maxdim, st.st_mtime_ns)
+        mimetype = "image/jpeg"
+    environ = {"REQUEST_METHOD": scope["method"], "HTTP_IF_NONE_MATCH": hdrs.get("if-none-match", ""),
+               "HTTP_IF_MODIFIED_SINCE": hdrs.get("if-modified-since", "")}
+    headers = [("ETag", '"' + etag + '"'), ("Last-Modified", http_date(lastModified)),
+               ("Cache-Control", "public, max-age=" + str(maxAge)), ("Expires", http_date(time.time() + maxAge))]
+    if not is_resource_modified(environ, etag=etag, last_modified=lastModified):
+        return await respond(send, 304, headers)
+    if maxdim == 0:
+        f = await run(fileExecutor, open, srcPath, "rb")
+    else:
+        f = await run(imageExecutor, app.imageCache.open, tablebase, path, srcPath, maxdim, st.st_mtime_ns)
+    await sendFile(send, f, [("Content-Type", mimetype)] + headers, scope["method"] == "HEAD")
+
+
+def environOf(scope, body, bodyLength):
+    hdrs = headersOf(scope)
+    (host, port) = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": host,
+        "SERVER_PORT": str(port),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "CONTENT_LENGTH": str(bodyLength),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for (k, v) in hdrs.items():
+        if k == "content-type":
+            environ["CONTENT_TYPE"] = v
+        elif k != "content-length":
+            key = "HTTP_" + k.upper().replace("-", "_")
+            environ[key] = environ[key] + "," + v if key in environ else v
+    return environ
+
+
+async def wsgi(scope, receive, send):
+    # the Flask app on a WSGI thread. The whole response is produced on that one thread, because
+    # streamed responses (stream_with_context) need their request context, which is per thread.
+    body = tempfile.SpooledTemporaryFile(MAX_BODY_IN_MEMORY)
+    length = 0
+    more = True
+    while more:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            body.close()
+            return
+        chunk = msg.get("body", b"")
+        body.write(chunk)
+        length += len(chunk)
+        more = msg.get("more_body", False)
+    body.seek(0)
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(QUEUE_CHUNKS)
+    done = object()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+    def startResponse(status, headers, excInfo=None):
+        put(("start", int(status.split(" ")[0]), headers))
+
+    def runApp():
+        try:
+            result = app.app(environOf(scope, body, length), startResponse)
+            try:
+                for chunk in result:
+                    if len(chunk) > 0:
+                        put(("body", chunk))
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        finally:
+            body.close()
+            put(done)
+
+    future = loop.run_in_executor(wsgiExecutor, runApp)
+    failed = None
+    while True:
+        item = await chunks.get()
+        if item is done:
+            break
+        if failed is not None:  # keep taking chunks, or the thread would block in put() forever
+            continue
+        try:
+            if item[0] == "start":
+                await send({"type": "http.response.start", "status": item[1],
+                            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for (k, v) in item[2]]})
+            else:
+                await send({"type": "http.response.body", "body": item[1], "more_body": True})
+        except Exception as e:  # client gone
+            failed = e
+    await future  # raises what the app raised
+    if failed is not None:
+        raise failed
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            for executor in [wsgiExecutor, fileExecutor, imageExecutor]:
+                executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    for (method, pattern, name) in routes:
+        m = pattern.fullmatch(scope["path"])
+        if name == "getImage" and "range" in headersOf(scope):  # Range requests are rare, send_file handles them
+            break
+        if m is not None and scope["method"] in (method, "HEAD" if method == "GET" else method):
+            start = time.perf_counter()
+            response = {}
+
+            async def sendRecorded(msg):
+                if msg["type"] == "http.response.start":
+                    response["status"] = msg["status"]
+                    response["length"] = {k.lower(): v for (k, v) in msg["headers"]}.get(b"content-length")
+                await send(msg)
+
+            await globals()[name](scope, receive, sendRecorded, *m.groups())
+            # the metrics of recordRequest in app.py, under the same endpoint names
+            metrics.requestSeconds.observe((name, scope["method"]), time.perf_counter() - start)
+            metrics.requestCount.inc((name, str(response.get("status", 0))))
+            if response.get("length") is not None:
+                metrics.responseBytes.observe((name,), int(response["length"]))
+            return
+    await wsgi(scope, receive, send)
@@ -0,0 +1,245 @@
+import argparse
+import base64
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+from PIL import Image
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.padding import PKCS7
+
+"""
+Micro benchmarks for the code that runs on every request.
+Runs offline: secrets and fb are replaced by stand-ins, the database is a local sqlite file,
+and everything the app writes goes to a temp directory.
+  python benchmarks.py --out base.json
+  python benchmarks.py --compare base.json   # exit code 1 if something got slower
+The load benchmarks send LOAD_REQUESTS requests through the Flask test client from --clients
+threads at once, like the clients reconnecting after a restart, and report the time per request
+(the inverse of the throughput, compared like the micro benchmarks) and the latencies.
+"""
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+REPEAT = 5
+LOAD_REQUESTS = 200
+
+benchmarks = {}
+loadBenchmarks = {}  # functions sending one request with the test client they get
+
+
+def benchmark(name):
+    def wrap(f):
+        benchmarks[name] = f
+        return f
+
+    return wrap
+
+
+def loadBenchmark(name):
+    def wrap(f):
+        loadBenchmarks[name] = f
+        return f
+
+    return wrap
+
+
+def loadApp(tmpDir):
+    # must run before anything imports app
+    secretsStub = types.ModuleType("secrets")
+    secretsStub.dburl = "sqlite:///" + os.path.join(tmpDir, "bench.db")
+    fbStub = types.ModuleType("fb")
+    fbStub.init = lambda app: None
+    sys.modules["secrets"] = secretsStub
+    sys.modules["fb"] = fbStub
+    sys.path.insert(0, SRC_DIR)
+    os.chdir(tmpDir)
+    import app
+    return app
+
+
+def encrypt(key, data):
+    iv = os.urandom(16)
+    padder = PKCS7(128).padder()
+    data = padder.update(data) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(data) + encryptor.finalize(), iv
+
+
+def daten(n):
+    now = datetime(2020, 7, 8, 12, 30, 15)
+    return [["creator" + str(i % 7), now, now, "Muenchen", 48.137154 + i / 1e5, 11.576124 + i / 1e5,
+             "48.1" + str(10000 + i), "11.5" + str(70000 + i), "Marienplatz " + str(i), i % 40, i % 3,
+             i % 2, 1, 0, 1, Decimal("0.5"), "mittel", "Bemerkung zu " + str(i)] for i in range(n)]
+
+
+def setup(app, tmpDir):
+    sharedKey = os.urandom(32)
+    app.sessionStore.setKey("bench", sharedKey)
+    app.sessionStore.login("bench", "bench", datetime.now())
+    now = str(int(time.time() * 1000))
+    enc, iv = encrypt(sharedKey, now.encode("utf-8"))
+    tokenJS = {"id": "bench", "now": now, "nowEnc": base64.b64encode(enc).decode("utf-8"),
+               "iv": base64.b64encode(iv).decode("utf-8")}
+    token = base64.b64encode(json.dumps(tokenJS).encode("utf-8"))
+
+    rows = daten(500)
+    configs = []
+    for path in sorted(glob.glob(os.path.join(SRC_DIR, "config", "*.json"))):
+        with open(path, "r", encoding="UTF-8") as jsonFile:
+            configs.append(json.load(jsonFile))
+
+    imgPath = os.path.join(tmpDir, "bench.jpg")
+    Image.effect_noise((1600, 1200), 64).convert("RGB").save(imgPath, format="jpeg")
+
+    @benchmark("verifyToken")
+    def _():
+        app.verifyToken(token, False)
+
+    @benchmark("DecEncoder_500_daten")
+    def _():
+        json.dumps(rows, cls=app.DecEncoder, separators=(",", ":"))
+
+    @benchmark("validate_configs")
+    def _():
+        for confJS in configs:
+            app.config.validate(confJS, [])
+
+    @benchmark("resize_1600x1200_to_200")
+    def _():
+        app.imagecache.resize(imgPath, 200)
+
+    @benchmark("normalize")
+    def _():
+        app.utils.normalize("Abstellplätze für Lastenräder 2020")
+
+    @benchmark("x25519_keypair")
+    def _():
+        app.keypool.generate()
+
+    pkbytes = X25519PrivateKey.generate().public_key().public_bytes(encoding=serialization.Encoding.Raw,
+                                                                    format=serialization.PublicFormat.Raw)
+    kexIds = iter(range(sys.maxsize))
+
+    @loadBenchmark("kex")
+    def _(client):
+        kexJS = {"pubkey": base64.b64encode(pkbytes).decode("utf-8"), "id": "kex" + str(next(kexIds))}
+        resp = client.post("/kex", json=kexJS)
+        assert resp.status_code == 200
+
+    app.db.engine.execute("CREATE TABLE users (email VARCHAR(100) PRIMARY KEY, username VARCHAR(100), "
+                          "encpw VARCHAR(100), UNIQUE(username))")
+    enc, iv = encrypt(sharedKey, json.dumps({"email": "bench@example.org", "password": "bench",
+                                             "username": "bench"}).encode("utf-8"))
+    authJS = {"id": "bench", "ctxt": base64.b64encode(enc).decode("utf-8"), "iv": base64.b64encode(iv).decode("utf-8")}
+    assert app.app.test_client().post("/auth/signon", json=authJS).status_code == 200
+
+    @loadBenchmark("auth_login")
+    def _(client):
+        resp = client.post("/auth/login", json=authJS)
+        assert resp.status_code == 200, resp.data
+
+
+def run(names):
+    results = {}
+    for name in names:
+        timer = timeit.Timer(benchmarks[name])
+        (number, _) = timer.autorange()
+        times = [t / number for t in timer.repeat(REPEAT, number)]
+        results[name] = {"number": number, "min": min(times), "median": statistics.median(times)}
+        print("%-28s %12.3f us  (median %.3f us, %d loops)" %
+              (name, results[name]["min"] * 1e6, results[name]["median"] * 1e6, number))
+    return results
+
+
+def waitForKeyPool(app):
+    # every run starts with a full pool, as after a restart
+    deadline = time.monotonic() + 60
+    while app.keyPool.available() < app.keyPool.size and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def runLoad(app, names, clients):
+    results = {}
+    local = threading.local()
+
+    def request(f):
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+        t0 = time.perf_counter()
+        f(local.client)
+        return time.perf_counter() - t0
+
+    for name in names:
+        runs = []
+        with ThreadPoolExecutor(clients) as executor:
+            for _ in range(REPEAT):
+                waitForKeyPool(app)
+                t0 = time.perf_counter()
+                latencies = sorted(executor.map(request, [loadBenchmarks[name]] * LOAD_REQUESTS))
+                runs.append(((time.perf_counter() - t0) / LOAD_REQUESTS, latencies))
+        (best, latencies) = min(runs, key=lambda run: run[0])
+        key = name + "_" + str(clients) + "_clients"
+        results[key] = {"number": LOAD_REQUESTS, "min": best, "median": statistics.median(run[0] for run in runs),
+                        "p50": statistics.median(latencies), "p95": latencies[int(len(latencies) * 0.95)]}
+        print("%-28s %12.3f us  (%d requests/s, latency p50 %.1f ms, p95 %.1f ms)" %
+              (key, best * 1e6, 1 / best, results[key]["p50"] * 1e3, results[key]["p95"] * 1e3))
+    return results
+
+
+def compare(results, basePath, threshold):
+    with open(basePath, "r", encoding="UTF-8") as f:
+        base = json.load(f)["results"]
+    slower = []
+    for (name, res) in results.items():
+        if name not in base:
+            continue
+        ratio = res["min"] / base[name]["min"]
+        flag = " SLOWER" if ratio > threshold else ""
+        print("%-28s %6.2fx%s" % (name, ratio, flag))
+        if flag != "":
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LocationsServer micro benchmarks")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown factor that counts as regression")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients of the load benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, default all")
+    args = parser.parse_args()
+    out = None if args.out is None else os.path.abspath(args.out)
+    basePath = None if args.compare is None else os.path.abspath(args.compare)
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        app = loadApp(tmpDir)
+        setup(app, tmpDir)
+        names = args.names if len(args.names) > 0 else list(benchmarks.keys()) + list(loadBenchmarks.keys())
+        results = run([name for name in names if name in benchmarks])
+        results.update(runLoad(app, [name for name in names if name in loadBenchmarks], args.clients))
+        os.chdir(SRC_DIR)
+    if out is not None:
+        meta = {"date": datetime.now().isoformat(), "python": platform.python_version(),
+                "machine": platform.machine(), "node": platform.node()}
+        with open(out, "w", encoding="UTF-8") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    if basePath is not None and len(compare(results, basePath, args.threshold)) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
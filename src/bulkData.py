@@ -0,0 +1,273 @@
+import argparse
+import csv
+import json
+import struct
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table
+
+import config
+import rowformat
+import secrets
+import spatial
+import upsert
+
+"""
+Export and import of whole _daten, _images and _zusatz tables, for backups, restores and
+test databases:
+  python bulkData.py export Sitzbaenke_daten sitzbaenke.locb
+  python bulkData.py import Sitzbaenke_daten sitzbaenke.locb
+  python bulkData.py export Sitzbaenke_daten sitzbaenke.csv --format csv
+Rows are read from a server side cursor and written in batches of BATCH_SIZE rows, both ways,
+so memory does not grow with the table. Import is an upsert (see upsert.py), one transaction
+per batch, and computes the spatial keys, which are not exported, like the changed column.
+Import writes to the database directly, running servers do not know about it: their region
+caches show the imported rows after REGION_CACHE_TTL seconds (see app.py and regioncache.py).
+/changes returns them to the clients, as their changed column is the time of the import.
+Column types are those of the config felder (and of the fixed columns), in both formats:
+csv has a header row with the column names, NULL is written as \\N and datetimes as DATE_FORMAT.
+The binary format is columnar: MAGIC, a length prefixed JSON header with table, columns and
+types, then blocks of up to BATCH_SIZE rows, each one zlib compressed and holding per column
+one null flag byte per row and the values (int and datetime as int64, float as float64,
+string as uint32 lengths followed by the UTF-8 bytes). A block of 0 rows ends the file.
+"""
+
+BATCH_SIZE = 10000
+DATE_FORMAT = "%Y.%m.%d %H:%M:%S"
+MAGIC = b"LOCB1\n"
+EPOCH = datetime(1970, 1, 1)
+NULL = "\\N"
+
+fixedTypes = {"nr": "int", "creator": "string", "created": "datetime", "modified": "datetime", "region": "string",
+              "lat": "float", "lon": "float", "lat_round": "string", "lon_round": "string",
+              "image_path": "string", "image_url": "string", "bemerkung": "string"}
+felderTypes = {"int": "int", "bool": "int", "prozent": "int", "string": "string", "float": "float"}
+dbTypes = {"int": "int", "bool": "int", "float": "float", "datetime": "datetime"}  # others are exported as strings
+
+
+def columnTypes(dbtable):
+    # the type of each exported column: fixed columns, then the felder of the newest config, then the database
+    (tablebase, _, table2) = dbtable.name.rpartition("_")
+    types = dict(fixedTypes)
+    baseConfig = config.Config()
+    configs = [c for name in baseConfig.getNames() for c in baseConfig.getBaseVersions(name)
+               if c.get("db_tabellenname") == tablebase]
+    if len(configs) > 0:
+        confJS = max(configs, key=lambda c: c["version"])
+        for feld in (confJS.get(table2) or {}).get("felder", []):
+            types[feld["name"]] = felderTypes.get(feld["type"], "string")
+    columns = [col for col in dbtable.columns if col.name not in spatial.SPATIAL_COLUMNS + (upsert.CHANGED_COLUMN,)]
+    return [(col.name, types.get(col.name) or dbTypes.get(rowformat.typeName(col), "string")) for col in columns]
+
+
+def toDatetime(v):
+    return v if isinstance(v, datetime) else datetime.strptime(v, DATE_FORMAT)
+
+
+def toText(typ, v):
+    if v is None:
+        return NULL
+    if typ == "datetime":
+        return toDatetime(v).strftime(DATE_FORMAT)
+    return str(v)
+
+
+def fromText(typ, s):
+    if s == NULL:
+        return None
+    if typ == "int":
+        return int(s)
+    if typ == "float":
+        return float(s)
+    if typ == "datetime":
+        return datetime.strptime(s, DATE_FORMAT)
+    return s
+
+
+def encodeColumn(typ, values):
+    n = len(values)
+    parts = [bytes(0 if v is None else 1 for v in values)]
+    if typ == "int":
+        parts.append(struct.pack("<%dq" % n, *[0 if v is None else int(v) for v in values]))
+    elif typ == "datetime":
+        parts.append(struct.pack("<%dq" % n, *[0 if v is None else int((toDatetime(v) - EPOCH).total_seconds())
+                                               for v in values]))
+    elif typ == "float":
+        parts.append(struct.pack("<%dd" % n, *[0.0 if v is None else float(v) for v in values]))
+    else:
+        data = [b"" if v is None else str(v).encode("utf-8") for v in values]
+        parts.append(struct.pack("<%dI" % n, *[len(d) for d in data]))
+        parts.extend(data)
+    return b"".join(parts)
+
+
+def decodeColumn(typ, n, buf, pos):
+    # returns the values and the position after them
+    flags = buf[pos:pos + n]
+    pos += n
+    if typ in ("int", "datetime", "float"):
+        vals = struct.unpack_from("<%d%s" % (n, "d" if typ == "float" else "q"), buf, pos)
+        pos += 8 * n
+        if typ == "datetime":
+            vals = [EPOCH + timedelta(seconds=v) for v in vals]
+    else:
+        lengths = struct.unpack_from("<%dI" % n, buf, pos)
+        pos += 4 * n
+        vals = []
+        for length in lengths:
+            vals.append(buf[pos:pos + length].decode("utf-8"))
+            pos += length
+    return [v if flag else None for (v, flag) in zip(vals, flags)], pos
+
+
+class BinaryWriter:
+    def __init__(self, f, tablename, types):
+        self.f = f
+        self.types = types
+        header = json.dumps({"table": tablename, "columns": [name for (name, _) in types],
+                             "types": [typ for (_, typ) in types]}).encode("utf-8")
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def write(self, rows):
+        cols = list(zip(*rows))
+        block = zlib.compress(b"".join(encodeColumn(typ, list(vals)) for ((_, typ), vals) in zip(self.types, cols)))
+        self.f.write(struct.pack("<II", len(rows), len(block)) + block)
+
+    def close(self):
+        self.f.write(struct.pack("<II", 0, 0))
+
+
+class BinaryReader:
+    def __init__(self, f):
+        self.f = f
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a bulkData file")
+        (length,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(length))
+        self.columns = header["columns"]
+        self.types = header["types"]
+
+    def __iter__(self):
+        while True:
+            (n, length) = struct.unpack("<II", self.f.read(8))
+            if n == 0:
+                return
+            buf = zlib.decompress(self.f.read(length))
+            pos = 0
+            cols = []
+            for typ in self.types:
+                (vals, pos) = decodeColumn(typ, n, buf, pos)
+                cols.append(vals)
+            yield list(zip(*cols))
+
+
+class CsvWriter:
+    def __init__(self, f, tablename, types):
+        self.writer = csv.writer(f)
+        self.types = types
+        self.writer.writerow([name for (name, _) in types])
+
+    def write(self, rows):
+        self.writer.writerows([toText(typ, v) for ((_, typ), v) in zip(self.types, row)] for row in rows)
+
+    def close(self):
+        pass
+
+
+class CsvReader:
+    def __init__(self, f, types):
+        self.reader = csv.reader(f)
+        self.columns = next(self.reader)
+        typeOf = dict(types)
+        self.types = [typeOf.get(name, "string") for name in self.columns]
+
+    def __iter__(self):
+        batch = []
+        for line in self.reader:
+            batch.append([fromText(typ, s) for (typ, s) in zip(self.types, line)])
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+
+def openFile(path, fmt, mode):
+    if fmt == "csv":
+        return open(path, mode, encoding="UTF-8", newline="")
+    return open(path, mode + "b")
+
+
+def export(engine, dbtable, path, fmt):
+    types = columnTypes(dbtable)
+    sel = sqlalchemy.select([dbtable.c[name] for (name, _) in types])
+    count = 0
+    t0 = time.perf_counter()
+    with openFile(path, fmt, "w") as f, engine.connect() as conn:
+        writer = CsvWriter(f, dbtable.name, types) if fmt == "csv" else BinaryWriter(f, dbtable.name, types)
+        r = conn.execution_options(stream_results=True).execute(sel)
+        while True:
+            rows = r.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            writer.write([tuple(row) for row in rows])
+            count += len(rows)
+        writer.close()
+    return count, time.perf_counter() - t0
+
+
+def load(engine, dbtable, path, fmt):
+    types = columnTypes(dbtable)
+    withKeys = spatial.hasKeys(dbtable)
+    count = 0
+    inserted = 0
+    t0 = time.perf_counter()
+    with openFile(path, fmt, "r") as f:
+        reader = CsvReader(f, types) if fmt == "csv" else BinaryReader(f)
+        unknown = [name for name in reader.columns if name not in dbtable.c]
+        if len(unknown) > 0:
+            raise ValueError("columns not in " + dbtable.name + ": " + ", ".join(unknown))
+        for batch in reader:
+            rows = [dict(zip(reader.columns, row)) for row in batch]
+            if withKeys:
+                for row in rows:
+                    spatial.addKeys(row)
+            with engine.begin() as conn:
+                (counts, _) = upsert.upsert(conn, dbtable, rows)
+            count += len(rows)
+            inserted += sum(ins for (ins, _) in counts)
+            print(count, "rows", end="\r")
+    return count, inserted, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export and import location tables")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("tablename", help="e.g. Sitzbaenke_daten")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["bin", "csv"], default=None,
+                        help="default csv for .csv files, else bin")
+    args = parser.parse_args()
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "bin")
+    engine = sqlalchemy.create_engine(secrets.dburl)
+    dbtable = Table(args.tablename, MetaData(), autoload=True, autoload_with=engine)
+    if args.command == "export":
+        (count, secs) = export(engine, dbtable, args.path, fmt)
+        print("%d rows exported in %.1fs, %.0f rows/s" % (count, secs, count / secs if secs > 0 else 0))
+    else:
+        (count, inserted, secs) = load(engine, dbtable, args.path, fmt)
+        print("%d rows imported (%d new) in %.1fs, %.0f rows/s" %
+              (count, inserted, secs, count / secs if secs > 0 else 0))
+        print("running servers show them in /region when their region cache expires, after REGION_CACHE_TTL")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
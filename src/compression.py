@@ -0,0 +1,73 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+gzip or brotli (if installed) for responses, chosen by the Accept-Encoding header.
+Buffered bodies are compressed in one go, streamed ones chunk by chunk, so that /table?stream=true
+stays streamed. Brotli is preferred, its quality is lower than the default to keep the CPU cost
+near that of gzip.
+"""
+
+MIN_SIZE = 1024  # smaller bodies do not get smaller enough to be worth it
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+encodings = (["br"] if brotli is not None else []) + ["gzip"]
+
+
+def negotiate(acceptEncodings):
+    return acceptEncodings.best_match(encodings)
+
+
+class Gzip:
+    def __init__(self):
+        self.z = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: with gzip header
+
+    def process(self, data):
+        return self.z.compress(data)
+
+    def flush(self):
+        return self.z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.z.flush()
+
+
+class Brotli:
+    def __init__(self):
+        self.z = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def process(self, data):
+        return self.z.process(data)
+
+    def flush(self):
+        return self.z.flush()
+
+    def finish(self):
+        return self.z.finish()
+
+
+def compressor(encoding):
+    return Brotli() if encoding == "br" else Gzip()
+
+
+def compress(encoding, data):
+    z = compressor(encoding)
+    return z.process(data) + z.finish()
+
+
+def compressStream(encoding, chunks):
+    # each chunk is flushed, so the client gets every batch as soon as the database delivered it
+    z = compressor(encoding)
+    try:
+        for chunk in chunks:
+            if len(chunk) > 0:
+                yield z.process(chunk) + z.flush()
+        yield z.finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
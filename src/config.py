@@ -1,5 +1,7 @@
 import glob
 import json
+import os
+import threading
 
 import utils
 
@@ -131,53 +133,175 @@ syntax = \
     }
 
 
+simpleTypes = {
+    "string": (str, "string "),
+    "int": (int, "int (d.h. eine ganze Zahl"),
+    "bool": (bool, "bool (d.h. true oder false)"),
+    "float": (float, "float (d.h. eine Gleitkommazahl)"),
+}
+
+
+# A syntax description is compiled once into nested check functions.
+# A check function appends all errors it finds to the list it gets.
+
+def compileSyntax(syn):
+    checks = [(synkey, spec.get("required"), compileType(synkey, spec)) for (synkey, spec) in syn.items()]
+
+    def check(js, errors):
+        for (synkey, required, checkType) in checks:
+            if synkey in js:
+                checkType(js[synkey], errors)
+            elif required:
+                errors.append(synkey + " wurde nicht spezifiziert")
+
+    return check
+
+
+def compileType(key, syn):
+    syntype = syn.get("type")
+    if isinstance(syntype, str) and syntype in simpleTypes:
+        (pyType, typeText) = simpleTypes[syntype]
+
+        def check(js, errors):
+            if not isinstance(js, pyType):
+                errors.append("Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt " + typeText)
+    elif syntype == "auswahl":
+        auswahl = syn.get("auswahl")
+
+        def check(js, errors):
+            if auswahl and js not in auswahl:
+                errors.append(str(js) + " nicht enthalten in der Auswahl " + str(auswahl))
+    elif syntype == "array":
+        elem = syn.get("elem")
+        checkElem = compileSyntax(elem) if isinstance(elem, dict) else compileSimpleType(key, elem)
+        checkDict = isinstance(elem, dict)
+
+        def check(js, errors):
+            if not isinstance(js, list):
+                errors.append("Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt eine Liste zu sein")
+                return
+            for v in js:
+                if checkDict and not isinstance(v, dict):
+                    errors.append("Ein Element im Feld " + key + " hat den Typ " + str(type(v)) +
+                                  " anstatt zusammengesetzt zu sein")
+                else:
+                    checkElem(v, errors)
+    elif isinstance(syntype, dict):
+        checkDict = compileSyntax(syntype)
+
+        def check(js, errors):
+            if isinstance(js, dict):
+                checkDict(js, errors)
+            else:
+                errors.append("Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt zusammengesetzt zu sein")
+    elif isinstance(syntype, list):
+        def check(js, errors):
+            errors.append("Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt eine Liste zu sein")
+    else:
+        raise ValueError("Unbekannter Typ " + str(syntype) + " im Feld " + key)
+    return check
+
+
+def compileSimpleType(key, syntype):
+    if syntype not in simpleTypes:
+        raise ValueError("Unbekannter Typ " + str(syntype) + " im Feld " + key)
+    (pyType, typeText) = simpleTypes[syntype]
+
+    def check(js, errors):
+        if not isinstance(js, pyType):
+            errors.append("Der wert " + str(js) + " im Feld " + key + " hat den Typ " + str(type(js)) +
+                          " anstatt " + typeText)
+
+    return check
+
+
+validate = compileSyntax(syntax)
+
+
 class Config():
+    # The parsed config files. refresh() rereads only files whose mtime changed.
     def __init__(self):
-        configDir = utils.getDataDir()
-        self.configs = {}
+        self.lock = threading.Lock()
+        self.files = {}  # path -> (mtime, confJS or None, error or None)
+        self.configs = {}  # name -> [confJS]
+        self.versions = {}  # (name, version) -> confJS
+        self.byFile = {}  # file name -> confJS
         self.errors = []
-        for dir in set([configDir, "."]):
-            self.file_list = sorted(glob.glob(dir + "/config/*.json"))
-            for f in self.file_list:
-                try:
-                    with open(f, "r", encoding="UTF-8") as jsonFile:
-                        confJS = json.load(jsonFile)
-                        try:
-                            self.checkSyntax(confJS, syntax)
-                        except Exception as e:
-                            utils.printEx("Kann Datei " + f + " nicht parsen:", e)
-                            self.errors.append("Kann Datei " + f + " nicht parsen:" + str(e))
-                            continue
-                        nm = confJS.get("name")
-                        l = self.configs.get(nm)
-                        if l is None:
-                            l = []
-                            self.configs[nm] = l
-                        l.append(confJS)
-                        print("gelesen:", f, nm)
-                except Exception as e:
-                    utils.printEx("Fehler beim Lesen von " + f, e)
+        self.refresh()
 
+    def refresh(self):
+        configDir = utils.getDataDir()
+        with self.lock:
+            paths = set()
+            for dir in set([configDir, "."]):
+                paths.update(glob.glob(dir + "/config/*.json"))
+            changed = False
+            for f in sorted(paths):
+                try:
+                    mtime = os.stat(f).st_mtime_ns
+                except OSError:
+                    continue
+                entry = self.files.get(f)
+                if entry is None or entry[0] != mtime:
+                    self.files[f] = (mtime,) + self.readFile(f)
+                    changed = True
+            for f in list(self.files.keys()):
+                if f not in paths:
+                    del self.files[f]
+                    changed = True
+            if changed:
+                self.index()
 
-    def checkConfig(self, data):
-        confJS = json.load(data)
+    def readFile(self, f):
         try:
-            self.checkSyntax(confJS, syntax)
+            with open(f, "r", encoding="UTF-8") as jsonFile:
+                confJS = json.load(jsonFile)
         except Exception as e:
-            utils.printEx("Kann neue Config-Daten nicht parsen:", e)
-            self.errors.append("Kann neue Config-Daten nicht parsen:" + str(e))
-            return None
-        return confJS
-
+            utils.printEx("Fehler beim Lesen von " + f, e)
+            return None, None
+        errors = []
+        validate(confJS, errors)
+        if len(errors) > 0:
+            msg = "Kann Datei " + f + " nicht parsen:" + "; ".join(errors)
+            print(msg)
+            return confJS, msg
+        print("gelesen:", f, confJS.get("name"))
+        return confJS, None
 
-    def addConfig(self, confJS):
-        nm = confJS.get("name")
-        l = self.configs.get(nm)
-        if l is None:
-            l = []
-            self.configs[nm] = l
-        l.append(confJS)
+    def index(self):
+        configs = {}
+        versions = {}
+        byFile = {}
+        errors = []
+        for f in sorted(self.files.keys()):
+            (_, confJS, error) = self.files[f]
+            if confJS is None:
+                continue
+            byFile[os.path.basename(f)] = confJS
+            if error is not None:
+                errors.append(error)
+                continue
+            nm = confJS.get("name")
+            l = configs.get(nm)
+            if l is None:
+                l = []
+                configs[nm] = l
+            l.append(confJS)
+            versions[(nm, confJS.get("version"))] = confJS
+        self.configs = configs
+        self.versions = versions
+        self.byFile = byFile
+        self.errors = errors
 
+    def checkConfig(self, data):
+        confJS = json.load(data)
+        errors = []
+        validate(confJS, errors)
+        if len(errors) > 0:
+            msg = "Kann neue Config-Daten nicht parsen:" + "; ".join(errors)
+            print(msg)
+            return None, [msg]
+        return confJS, []
 
     def getNames(self):
         return list(self.configs.keys())
@@ -185,87 +309,29 @@ class Config():
     def getBaseVersions(self, name):
         return self.configs.get(name,  [])
 
-    def checkSyntax(self, js, syn):
-        for synkey in syn.keys():
-            required = syn.get(synkey).get("required")
-            # print("checksyntax", "key:", synkey, "req:", required)
-            if synkey in js.keys():
-                self.checkType(synkey, syn.get(synkey), js.get(synkey))
-            elif required:
-                raise (ValueError(synkey + " wurde nicht spezifiziert"))
-
-    def checkType(self, key, syn, js):
-        syntype = syn.get("type")
-        # print("checktype", "key:", key, "type:", syntype, "js:", js)
-        if syntype == "string":
-            if not isinstance(js, str):
-                raise (ValueError("Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt string "))
-        elif syntype == "int":
-            if not isinstance(js, int):
-                raise (ValueError(
-                    "Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt int (d.h. eine ganze Zahl"))
-        elif syntype == "bool":
-            if not isinstance(js, bool):
-                raise (ValueError(
-                    "Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt bool (d.h. true oder false)"))
-        elif syntype == "float":
-            if not isinstance(js, float):
-                raise (ValueError(
-                    "Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt float (d.h. eine Gleitkommazahl)"))
-        elif syntype == "auswahl":
-            auswahl = syn.get("auswahl")
-            if auswahl and js not in auswahl:
-                raise ValueError(js + " nicht enthalten in der Auswahl " + str(auswahl))
-        elif syntype == "array":
-            if not isinstance(js, list):
-                raise (ValueError("Das Feld " + key + " hat den Typ " + str(
-                    type(js)) + " anstatt eine Liste zu sein"))
-            else:
-                syn = syn.get("elem")
-                if isinstance(syn, dict):
-                    for v in js:
-                        self.checkSyntax(v, syn)
-                else:
-                    for x in js:
-                        self.checkSimpleType(key, x, syn)
-        elif isinstance(syntype, dict):
-            if isinstance(js, dict):
-                self.checkSyntax(js, syntype)
-            else:
-                raise (ValueError(
-                    "Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt zusammengesetzt zu sein"))
-        elif isinstance(syntype, list):
-            raise (ValueError("Das Feld " + key + " hat den Typ " + str(type(js)) + " anstatt eine Liste zu sein"))
-        else:  # if isinstance(syntype, array):
-            raise ValueError("!!")
-
-    def checkSimpleType(self, key, js, syntype):
-        # print("checksimpletype", "key", key, "type:", syntype, "js:", js)
-        if syntype == "string":
-            if not isinstance(js, str):
-                raise ValueError(
-                    "Der wert " + str(js) + " im Feld " + key + " hat den Typ " + str(type(js)) + " anstatt string ")
-        elif syntype == "int":
-            if not isinstance(js, int):
-                raise ValueError(
-                    "Der wert " + str(js) + " im Feld " + key + " hat den Typ " + str(
-                        type(js)) + " anstatt int (d.h. eine ganze Zahl")
-        elif syntype == "bool":
-            if not isinstance(js, bool):
-                raise ValueError(
-                    "Der wert " + str(js) + " im Feld " + key + " hat den Typ " + str(
-                        type(js)) + " anstatt bool (d.h. true oder false)")
-        elif syntype == "float":
-            if not isinstance(js, float):
-                raise ValueError(
-                    "Der wert " + str(js) + " im Feld " + key + " hat den Typ " + str(
-                        type(js)) + " anstatt float (d.h. eine Gleitkommazahl)")
-        else:
-            raise ValueError("Unbekannter Typ " + syntype + "im Feld " + key)
+    def getConfig(self, name, version):
+        return self.versions.get((name, version))
+
+    def getFile(self, filename):
+        # the parsed content of config/<filename>, also if it is not a valid config
+        self.refresh()
+        return self.byFile.get(filename)
 
     def getErrors(self):
         return "\n".join(self.errors)
 
+
+registry = None
+
+
+def getRegistry():
+    # the Config shared by all requests of this process
+    global registry
+    if registry is None:
+        registry = Config()
+    return registry
+
+
 if __name__ == "__main__":
     cfg = Config()
     print("Geparst", cfg.getNames())
@@ -0,0 +1,40 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+"""
+Response bodies built from files (config files, marker codes, and the directory listings of
+both), kept in memory with a strong ETag. An entry is built again when the mtime or size of
+its file or directory changed, so writes by another WSGI process are noticed too, or when
+the writing endpoint of this process calls invalidate().
+"""
+
+
+class FileCache:
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (stamp, body, etag), least recently used first
+
+    def get(self, key, path, build):
+        # build() returns the body as bytes, it is called without the lock
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(key)
+                return entry[1], entry[2]
+        body = build()
+        etag = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            self.entries[key] = (stamp, body, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return body, etag
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
@@ -0,0 +1,102 @@
+import hashlib
+import io
+import os
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+import metrics
+
+"""
+On-disk cache of the JPEGs /getimage derives from the uploaded images.
+An entry is keyed by tablebase, image name, maxdim and the mtime of the source, so a
+changed source never hits an old entry; VERSION changes whenever resize() does.
+A hit touches the file's mtime, and when the directory grows beyond maxBytes the least
+recently used files are removed. Since the LRU order lives in the file system, all WSGI
+processes can share one cache directory.
+"""
+
+VERSION = 2  # 2: EXIF orientation applied
+
+
+def resize(srcPath, maxdim):
+    t0 = time.perf_counter()
+    img = Image.open(srcPath)
+    img.load()
+    t1 = time.perf_counter()
+    metrics.pilSeconds.observe(("decode",), t1 - t0)
+    img = ImageOps.exif_transpose(img)
+    iw = img.width
+    ih = img.height
+    if maxdim != 0:
+        xw = iw / maxdim
+        xh = ih / maxdim
+        x = xh if xw < xh else xw
+        w = int(iw / x)
+        h = int(ih / x)
+        img = img.resize(size=(w, h))
+    t2 = time.perf_counter()
+    metrics.pilSeconds.observe(("resize",), t2 - t1)
+    buf = io.BytesIO()
+    img.save(buf, format="jpeg")
+    metrics.pilSeconds.observe(("encode",), time.perf_counter() - t2)
+    return buf.getvalue()
+
+
+class ImageCache:
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(cacheDir, exist_ok=True)
+        self.size = sum(size for (_, _, size) in self.scan())
+
+    def etag(self, tablebase, name, maxdim, mtime):
+        key = str(VERSION) + "/" + tablebase + "/" + name + "/" + str(maxdim) + "/" + str(mtime)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def open(self, tablebase, name, srcPath, maxdim, mtime):
+        # returns an open file with the derived JPEG, creating it if necessary
+        path = os.path.join(self.cacheDir, self.etag(tablebase, name, maxdim, mtime) + ".jpg")
+        try:
+            f = open(path, "rb")
+            os.utime(path)
+            return f
+        except FileNotFoundError:
+            pass
+        data = resize(srcPath, maxdim)
+        tmpPath = path + "." + str(os.getpid()) + "." + str(threading.get_ident())
+        with open(tmpPath, "wb") as tmpFile:
+            tmpFile.write(data)
+        os.replace(tmpPath, path)
+        f = open(path, "rb")
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.maxBytes:
+                self.evict()
+        return f
+
+    def scan(self):
+        entries = []
+        for entry in os.scandir(self.cacheDir):
+            try:
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.path, st.st_size))
+            except FileNotFoundError:  # evicted by another process
+                pass
+        return entries
+
+    def evict(self):
+        # other processes write to the same directory, so recount before deleting
+        entries = sorted(self.scan())
+        size = sum(size for (_, _, size) in entries)
+        for (_, path, fsize) in entries:
+            if size <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= fsize
+        self.size = size
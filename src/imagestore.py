@@ -0,0 +1,321 @@
+import fcntl
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+
+from PIL import Image
+
+import utils
+
+"""
+Storage of uploaded images under images/<tablebase>/yyyy/mm/dd/<name>.
+An upload is streamed into a temp file next to its final place and renamed atomically
+when complete, so readers never see a partial image. Validation and the thumbnails are
+done afterwards by a PostProcessor thread, the upload request does not wait for them.
+The bytes are stored once per content, in images/.blobs/<sha256>, and every name is a hard
+link to its blob, so the link count of the blob is its reference count: the blob goes when
+its last name is deleted. A client that sends the hash in advance (x-sha256) of bytes that
+are already stored gets the name linked without uploading them again.
+The digest is also stored in an extended attribute of the blob, which all its names share,
+so deleting a name finds its blob without hashing the file (blobs without it are hashed once).
+Linking, and the check of the link count before a blob is removed, are done under BlobLock,
+which excludes the threads of this process and the other WSGI processes.
+An upload that is not a valid image is deleted by the PostProcessor together with its blob.
+"""
+
+CHUNK_SIZE = (64 * 1024)
+BLOB_DIR = os.path.join("images", ".blobs")
+
+DIGEST_XATTR = "user.sha256"
+
+
+class BlobLock:
+    # a reentrant lock between linking to a blob and removing it: an RLock for the threads,
+    # and flock on a lock file for the processes
+    def __init__(self):
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+        self.pid = None
+
+    def __enter__(self):
+        self.rlock.acquire()
+        try:
+            if self.depth == 0:
+                if self.pid != os.getpid():  # a descriptor inherited by fork would share the lock
+                    os.makedirs(BLOB_DIR, exist_ok=True)
+                    self.fd = os.open(os.path.join(BLOB_DIR, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+                    self.pid = os.getpid()
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            self.depth += 1
+        except BaseException:
+            self.rlock.release()
+            raise
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.rlock.release()
+        return False
+
+
+lock = BlobLock()
+
+
+class TooLarge(ValueError):
+    pass
+
+
+class BadDigest(ValueError):
+    pass
+
+
+def validName(name):
+    # <lat>_<lon>_<yyyymmdd>..., the shape imageDir() needs, and no path
+    parts = name.split("_")
+    return os.path.basename(name) == name and len(parts) >= 3 and len(parts[2]) >= 8 and parts[2][0:8].isdigit()
+
+
+def imageDir(tablebase, name):
+    datum = name.split("_")[2]  # 20200708
+    yr = datum[0:4]
+    mo = datum[4:6]
+    dy = datum[6:8]
+    return os.path.join("images", tablebase, yr, mo, dy)
+
+
+def imagePath(tablebase, name):
+    return os.path.join(imageDir(tablebase, name), name)
+
+
+def fileEtag(st):
+    # the ETag of an original image, from os.stat of its file; app.py and asgi.py send the same
+    return "%x-%x" % (st.st_mtime_ns, st.st_size)
+
+
+def parseDigest(value):
+    # the x-sha256 of an upload as lowercase hex, or None if not given
+    if value is None:
+        return None
+    digest = value.lower()
+    if len(digest) != 64 or any(ch not in "0123456789abcdef" for ch in digest):
+        raise BadDigest("Invalid x-sha256")
+    return digest
+
+
+def blobPath(digest):
+    return os.path.join(BLOB_DIR, digest[0:2], digest)
+
+
+def fileDigest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blobDigest(path):
+    # the digest of a stored image, from the attribute of its blob if it has one
+    try:
+        return os.getxattr(path, DIGEST_XATTR).decode("ascii")
+    except OSError:  # stored before, or no extended attributes on this file system
+        digest = fileDigest(path)
+        setDigest(path, digest)
+        return digest
+
+
+def setDigest(path, digest):
+    try:
+        os.setxattr(path, DIGEST_XATTR, digest.encode("ascii"))
+    except OSError:
+        pass
+
+
+def fsyncDir(dirPath):
+    dirFd = os.open(dirPath, os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+
+def linkBlob(blob, path):
+    # makes path a name of blob, replacing what path was before. False if there is no such blob.
+    tmpLink = path + "." + os.urandom(4).hex() + ".lnk"
+    with lock:
+        try:
+            os.link(blob, tmpLink)
+        except FileNotFoundError:
+            return False
+    try:
+        if os.path.samefile(tmpLink, path):  # already linked, and rename() would do nothing
+            os.remove(tmpLink)
+            return True
+    except FileNotFoundError:
+        pass
+    with lock:
+        orphan = orphanBlob(path)
+        os.replace(tmpLink, path)
+        if orphan is not None and orphan != blob:
+            removeBlob(orphan)
+    return True
+
+
+def orphanBlob(path):
+    # the blob that has no other name than path, if there is one. Call it under lock.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if st.st_nlink != 2:  # other names, or stored before the blobs existed
+        return None
+    blob = blobPath(blobDigest(path))
+    try:
+        return blob if os.path.samefile(blob, path) else None
+    except FileNotFoundError:
+        return None
+
+
+def removeBlob(blob):
+    with lock:
+        try:
+            if os.stat(blob).st_nlink == 1:  # nobody linked it meanwhile
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+
+def linkExisting(tablebase, name, digest):
+    # stores the image under name if the bytes with this hash are stored already
+    dirPath = imageDir(tablebase, name)
+    os.makedirs(dirPath, exist_ok=True)
+    if not linkBlob(blobPath(digest), os.path.join(dirPath, name)):
+        return False
+    fsyncDir(dirPath)
+    return True
+
+
+def remove(tablebase, name):
+    # False if there is no such image
+    path = imagePath(tablebase, name)
+    with lock:
+        orphan = orphanBlob(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        if orphan is not None:
+            removeBlob(orphan)
+    return True
+
+
+def discard(tablebase, name, st):
+    # removes an image that is not valid, and its blob, so that no upload with its x-sha256 is linked to these
+    # bytes again. st is os.stat of the checked file, the name may have been uploaded again since.
+    path = imagePath(tablebase, name)
+    with lock:
+        try:
+            if not os.path.samestat(os.stat(path), st):
+                return
+            blob = blobPath(blobDigest(path))
+            if os.path.samefile(blob, path):
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+        remove(tablebase, name)
+
+
+class Upload:
+    def __init__(self, tablebase, name, maxSize, expectedDigest=None):
+        dirPath = imageDir(tablebase, name)
+        os.makedirs(dirPath, exist_ok=True)
+        self.path = os.path.join(dirPath, name)
+        self.maxSize = maxSize
+        self.expectedDigest = expectedDigest
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.digest = None
+        self.stored = False
+        (fd, self.tmpPath) = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=dirPath)
+        self.file = os.fdopen(fd, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if self.file is not None:  # not committed
+            self.file.close()
+        if os.path.exists(self.tmpPath):
+            os.remove(self.tmpPath)
+        return False
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.maxSize:
+            raise TooLarge("Bild größer als " + str(self.maxSize) + " Bytes")
+        self.hash.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        self.digest = self.hash.hexdigest()
+        if self.expectedDigest is not None and self.expectedDigest != self.digest:
+            raise BadDigest("sha256 " + self.digest + " statt " + self.expectedDigest)
+        blob = blobPath(self.digest)
+        self.stored = not linkBlob(blob, self.path)
+        if self.stored:  # new content
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            os.chmod(self.tmpPath, 0o644)  # mkstemp creates 0600
+            setDigest(self.tmpPath, self.digest)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            with lock:  # a blob with a link count of 1 would be removed by removeBlob
+                os.replace(self.tmpPath, blob)
+                linkBlob(blob, self.path)
+            fsyncDir(os.path.dirname(blob))
+        self.file.close()
+        self.file = None
+        fsyncDir(os.path.dirname(self.path))
+
+
+class PostProcessor:
+    def __init__(self, imageCache, sizes, threads, queueSize):
+        self.imageCache = imageCache
+        self.sizes = sizes
+        self.queue = queue.Queue(queueSize)
+        for _ in range(threads):
+            threading.Thread(target=self.run, name="imagestore", daemon=True).start()
+
+    def submit(self, tablebase, name):
+        try:
+            self.queue.put_nowait((tablebase, name))
+        except queue.Full:  # the thumbnails will be created on first request
+            print("post processing queue full, skipping", name)
+
+    def run(self):
+        while True:
+            (tablebase, name) = self.queue.get()
+            try:
+                self.process(tablebase, name)
+            except Exception as e:
+                utils.printEx("post processing of " + name + " failed", e)
+
+    def process(self, tablebase, name):
+        path = imagePath(tablebase, name)
+        try:
+            st = os.stat(path)
+            with Image.open(path) as img:
+                img.verify()
+        except FileNotFoundError:  # deleted in the meantime
+            return
+        except Exception as e:
+            print("invalid image", path, e)
+            discard(tablebase, name, st)
+            return
+        mtime = os.stat(path).st_mtime_ns
+        for maxdim in self.sizes:
+            self.imageCache.open(tablebase, name, path, maxdim, mtime).close()
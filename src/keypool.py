@@ -0,0 +1,51 @@
+import base64
+import queue
+import threading
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+import metrics
+
+"""
+Ephemeral X25519 keypairs for /kex, generated ahead by a background thread, so that the burst
+of key exchanges after a restart does not wait for key generation. Every keypair is taken out
+of the pool and used for one exchange only, as forward secrecy requires; it is never returned.
+If the pool is empty, take() generates a keypair itself, the pool only saves time.
+The pool is per process, a thread started before a fork does not run in the child, so create
+the pool in the process that uses it (mod_wsgi imports app.py in each process).
+"""
+
+keysTaken = metrics.Counter("locations_kex_keys_total", "Keypairs for /kex taken from the pool or generated inline",
+                            ("source",))
+
+
+def generate():
+    # returns the private key and its public key as base64 of the raw bytes, as /kex sends it
+    privkey = X25519PrivateKey.generate()
+    pkbytes = privkey.public_key().public_bytes(encoding=serialization.Encoding.Raw,
+                                                format=serialization.PublicFormat.Raw)
+    return privkey, base64.b64encode(pkbytes).decode("utf-8")
+
+
+class KeyPool:
+    def __init__(self, size):
+        self.size = size
+        self.queue = queue.Queue(size)
+        threading.Thread(target=self.run, name="keypool", daemon=True).start()
+
+    def run(self):
+        while True:
+            self.queue.put(generate())  # blocks while the pool is full
+
+    def take(self):
+        try:
+            keypair = self.queue.get_nowait()
+            keysTaken.inc(("pool",))
+            return keypair
+        except queue.Empty:
+            keysTaken.inc(("inline",))
+            return generate()
+
+    def available(self):
+        return self.queue.qsize()
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import socket
+import statistics
+import time
+import urllib.parse
+
+"""
+Load test for slow clients: --slow connections download an image with a small receive buffer
+at --rate bytes per second each, like phones on a bad mobile link, while /configs is requested
+every --interval seconds and its latency recorded. With more slow clients than server threads,
+a WSGI server stops answering /configs, asgi.py should not.
+  uvicorn asgi:application --port 8080 &
+  python loadtest.py --url http://localhost:8080 --image /getimage/<tablebase>/<name> --slow 20
+"""
+
+
+async def connect(host, port, rcvbuf):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf is not None:  # before connect, so that the window stays small
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, (host, port))
+    return await asyncio.open_connection(sock=sock)
+
+
+async def get(host, port, path, rcvbuf=None, rate=None):
+    # returns the status and the body size, reading at most rate bytes per second
+    (reader, writer) = await connect(host, port, rcvbuf)
+    try:
+        writer.write(("GET " + path + " HTTP/1.1\r\nHost: " + host + "\r\nConnection: close\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        status = int((await reader.readline()).split(b" ")[1])
+        size = 0
+        while True:
+            chunk = await reader.read(1024 if rate is not None else 65536)
+            if not chunk:
+                break
+            size += len(chunk)
+            if rate is not None:
+                await asyncio.sleep(len(chunk) / rate)
+        return status, size
+    finally:
+        writer.close()
+
+
+async def slowClient(host, port, path, rate, until, stats):
+    while time.monotonic() < until:
+        stats["inflight"] += 1
+        try:
+            (status, _) = await asyncio.wait_for(get(host, port, path, rcvbuf=4096, rate=rate),
+                                                 timeout=until - time.monotonic())
+            stats["done" if status == 200 else "errors"] += 1
+        except asyncio.TimeoutError:  # still downloading at the end of the test
+            stats["unfinished"] += 1
+        except OSError as e:
+            stats["errors"] += 1
+            print("slow client:", e)
+        finally:
+            stats["inflight"] -= 1
+
+
+async def probe(host, port, path, interval, until, stats, latencies):
+    while time.monotonic() < until:
+        t0 = time.perf_counter()
+        try:
+            (status, _) = await asyncio.wait_for(get(host, port, path), timeout=max(until - time.monotonic(), 1))
+            latencies.append(time.perf_counter() - t0)
+            print("%6.3fs  %s %d  with %d slow downloads in flight" %
+                  (latencies[-1], path, status, stats["inflight"]))
+        except asyncio.TimeoutError:
+            print("%s timed out with %d slow downloads in flight" % (path, stats["inflight"]))
+        await asyncio.sleep(interval)
+
+
+async def main(args):
+    url = urllib.parse.urlsplit(args.url)
+    (host, port) = (url.hostname, url.port or 80)
+    until = time.monotonic() + args.duration
+    stats = {"inflight": 0, "done": 0, "errors": 0, "unfinished": 0}
+    latencies = []
+    tasks = [slowClient(host, port, args.image, args.rate, until, stats) for _ in range(args.slow)]
+    await asyncio.sleep(0)
+    tasks.append(probe(host, port, args.probe, args.interval, until, stats, latencies))
+    await asyncio.gather(*tasks)
+    print("%d slow downloads done, %d errors, %d were still running at the end" %
+          (stats["done"], stats["errors"], stats["unfinished"]))
+    if len(latencies) > 0:
+        latencies.sort()
+        print("%s: %d requests, median %.3fs, p95 %.3fs, max %.3fs" %
+              (args.probe, len(latencies), statistics.median(latencies),
+               latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], latencies[-1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="slow client load test")
+    parser.add_argument("--url", default="http://localhost:8080", help="server base url")
+    parser.add_argument("--image", required=True, help="path of an image, e.g. /getimage/<tablebase>/<name>")
+    parser.add_argument("--slow", type=int, default=20, help="number of slow clients")
+    parser.add_argument("--rate", type=float, default=16384, help="bytes per second per slow client")
+    parser.add_argument("--probe", default="/configs", help="path whose latency is measured")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between probe requests")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,118 @@
+import bisect
+import threading
+
+"""
+Request metrics in the Prometheus text format, served by /metrics.
+Every WSGI process has its own values, so with several processes each scrape sees one of them.
+"""
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def labelString(labelNames, labels, extra=""):
+    parts = [n + '="' + escape(v) + '"' for (n, v) in zip(labelNames, labels)]
+    if extra != "":
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+
+class Counter:
+    def __init__(self, name, help, labelNames):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, labels, n=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self, lines):
+        lines.append("# HELP " + self.name + " " + self.help)
+        lines.append("# TYPE " + self.name + " counter")
+        with self.lock:
+            for (labels, value) in sorted(self.values.items()):
+                lines.append(self.name + labelString(self.labelNames, labels) + " " + str(value))
+
+
+class Histogram:
+    def __init__(self, name, help, labelNames, buckets):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {}  # labels -> [count per bucket..., count above the last bucket, sum]
+        registry.append(self)
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[labels] = entry
+            entry[i] += 1
+            entry[-1] += value
+
+    def render(self, lines):
+        lines.append("# HELP " + self.name + " " + self.help)
+        lines.append("# TYPE " + self.name + " histogram")
+        with self.lock:
+            items = sorted((labels, list(entry)) for (labels, entry) in self.values.items())
+        for (labels, entry) in items:
+            total = 0
+            for (bound, n) in zip(self.buckets, entry):
+                total += n
+                lines.append(self.name + "_bucket" + labelString(self.labelNames, labels, 'le="' + str(bound) + '"') +
+                             " " + str(total))
+            total += entry[-2]
+            lines.append(self.name + "_bucket" + labelString(self.labelNames, labels, 'le="+Inf"') + " " + str(total))
+            lines.append(self.name + "_sum" + labelString(self.labelNames, labels) + " " + repr(entry[-1]))
+            lines.append(self.name + "_count" + labelString(self.labelNames, labels) + " " + str(total))
+
+
+class Gauge:
+    # the value is read from fn when /metrics is scraped; with labelNames fn returns {labels: value}
+    def __init__(self, name, help, fn, labelNames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelNames = labelNames
+        registry.append(self)
+
+    def render(self, lines):
+        lines.append("# HELP " + self.name + " " + self.help)
+        lines.append("# TYPE " + self.name + " gauge")
+        values = self.fn() if len(self.labelNames) > 0 else {(): self.fn()}
+        for (labels, value) in values.items():
+            lines.append(self.name + labelString(self.labelNames, labels) + " " + str(value))
+
+
+def render():
+    lines = []
+    for metric in registry:
+        metric.render(lines)
+    return "\n".join(lines) + "\n"
+
+
+requestSeconds = Histogram("locations_request_seconds", "Request latency by endpoint",
+                           ("endpoint", "method"), LATENCY_BUCKETS)
+requestCount = Counter("locations_requests_total", "Requests by endpoint and status", ("endpoint", "status"))
+responseBytes = Histogram("locations_response_bytes", "Response size by endpoint, if known in advance",
+                          ("endpoint",), SIZE_BUCKETS)
+dbSeconds = Histogram("locations_db_execute_seconds", "SQL statement execution time by endpoint",
+                      ("endpoint",), LATENCY_BUCKETS)
+pilSeconds = Histogram("locations_pil_seconds", "Time spent in PIL for derived images by step",
+                       ("step",), LATENCY_BUCKETS)
+regionCacheTiles = Counter("locations_region_cache_tiles_total", "Grid tiles of /region found in the cache or read",
+                           ("result",))
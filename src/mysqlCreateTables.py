@@ -1,9 +1,12 @@
 import locale
+import time
 
 import mysql.connector
 
 import config
+import onlineMigration
 import secrets
+import spatial
 import utils
 
 """
@@ -15,13 +18,31 @@ and that the user locationsuser@localhost can only access data
 sqtype = {"int": "INT", "bool": "TINYINT", "prozent": "TINYINT", "string": "VARCHAR(2048)", "float": "DOUBLE"}
 
 
+spatialFields = ["lat_int INT", "lon_int INT", "cell INT"]
+# server time of the last insert or update, for /changes: created and modified are set by the clients
+changedField = "changed DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)"
+
+POOL_SIZE = 2
+
+
 # Note: The "on conflict replace" is not available in mysql.
 
 class MySqlCreateTables:
-    def getConn(self):
+    """
+    All statements of one run (initDB, updateDB, ...) go over one connection, taken from a small
+    pool and given back by close(). The statements are MySQL/MariaDB specific.
+    Every statement is timed, the timings of the run are in self.timings as (step, seconds).
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.timings = []
+
+    def mysqlConnect(self):
         try:
             mydb = mysql.connector.connect(user='creator', password=secrets.creator_password,
-                                           host=secrets.dbhost, database='locationsdb')
+                                           host=secrets.dbhost, database='locationsdb',
+                                           pool_name="creator", pool_size=POOL_SIZE)
         except mysql.connector.Error as _:
             try:
                 mydb = mysql.connector.connect(user='creator', password='xxx123',
@@ -31,7 +52,7 @@ class MySqlCreateTables:
                     mycursor.execute("CREATE DATABASE locationsdb")
                 except:
                     pass
-                mycursor.execute("GRANT CREATE,DROP,INDEX,ALTER,GRANT OPTION ON locationsdb.* TO 'creator'@'%'")
+                mycursor.execute("GRANT CREATE,DROP,INDEX,ALTER,TRIGGER,GRANT OPTION ON locationsdb.* TO 'creator'@'%'")
 
                 # call this as root? mycursor.execute("GRANT SELECT,INSERT,UPDATE,DELETE ON " + self.tabellenname +
                 # ".* TO 'locationsuser'@'%'")
@@ -43,6 +64,30 @@ class MySqlCreateTables:
                 return None
         return mydb
 
+    def getConn(self):
+        if self.conn is None:
+            self.conn = self.mysqlConnect()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()  # a pooled connection goes back to the pool
+            self.conn = None
+
+    def execute(self, c, stmt, parms=None, step=None):
+        t0 = time.perf_counter()
+        if parms is None:
+            c.execute(stmt)
+        else:
+            c.execute(stmt, parms)
+        self.timings.append((stmt.split(" (")[0] if step is None else step, time.perf_counter() - t0))
+
+    def printTimings(self):
+        total = sum(secs for (_, secs) in self.timings)
+        print("migration of", self.tabellenname, "took %.3fs in %d statements" % (total, len(self.timings)))
+        for (step, secs) in self.timings:
+            print("  %8.3fs  %s" % (secs, step))
+
     def initDB(self, baseJS):
         fields = ["creator VARCHAR(40) NOT NULL", "created DATETIME NOT NULL", "modified DATETIME NOT NULL",
                   "region VARCHAR(20)", "lat DOUBLE NOT NULL", "lon DOUBLE NOT NULL",
@@ -51,25 +96,33 @@ class MySqlCreateTables:
             name = feld.get("name")
             type = sqtype[feld.get("type")]
             fields.append(name + " " + type)
+        fields.extend(spatialFields)
+        fields.append(changedField)
         fields.append("PRIMARY KEY (creator, lat_round, lon_round)")
         stmt1 = "CREATE TABLE IF NOT EXISTS " + self.tabellenname + "_daten (" + ", ".join(fields) + ")"
         stmt2 = "CREATE INDEX IF NOT EXISTS latlonrnd_daten ON " + self.tabellenname + "_daten (lat_round, lon_round)"
 
         conn = self.getConn()
         c = conn.cursor()
-        c.execute(stmt1)
-        c.execute(stmt2)
+        self.execute(c, stmt1)
+        self.execute(c, stmt2)
+        self.execute(c, self.gridIndex("_daten"))
+        self.execute(c, self.modifiedIndex("_daten", "changed"))
 
         fields = ["creator VARCHAR(40) NOT NULL", "created DATETIME NOT NULL", "region VARCHAR(20)",
                   "lat DOUBLE NOT NULL", "lon DOUBLE NOT NULL",
                   "lat_round VARCHAR(20) NOT NULL", "lon_round VARCHAR(20) NOT NULL",
-                  "image_path VARCHAR(256)", "image_url VARCHAR(256)", "bemerkung VARCHAR(256)",
-                  "PRIMARY KEY (image_path)"]
+                  "image_path VARCHAR(256)", "image_url VARCHAR(256)", "bemerkung VARCHAR(256)"]
+        fields.extend(spatialFields)
+        fields.append(changedField)
+        fields.append("PRIMARY KEY (image_path)")
         stmt1 = "CREATE TABLE IF NOT EXISTS " + self.tabellenname + "_images (" + ", ".join(fields) + ")"
         stmt2 = "CREATE INDEX IF NOT EXISTS latlonrnd_images ON " + self.tabellenname + "_images (lat_round, lon_round)"
         c = conn.cursor()
-        c.execute(stmt1)
-        c.execute(stmt2)
+        self.execute(c, stmt1)
+        self.execute(c, stmt2)
+        self.execute(c, self.gridIndex("_images"))
+        self.execute(c, self.modifiedIndex("_images", "changed"))
 
         if baseJS.get("zusatz", None) is None:
             return
@@ -81,16 +134,89 @@ class MySqlCreateTables:
             name = feld.get("name")
             type = sqtype[feld.get("type")]
             fields.append(name + " " + type)
+        fields.extend(spatialFields)
+        fields.append(changedField)
         fields.append("UNIQUE(creator, created, modified, lat_round, lon_round)")
         stmt1 = "CREATE TABLE IF NOT EXISTS " + self.tabellenname + "_zusatz (" + ", ".join(fields) + ")"
         stmt2 = "CREATE INDEX IF NOT EXISTS latlonrnd_zusatz ON " + self.tabellenname + "_zusatz (lat_round, lon_round)"
         c = conn.cursor()
-        c.execute(stmt1)
-        c.execute(stmt2)
+        self.execute(c, stmt1)
+        self.execute(c, stmt2)
+        self.execute(c, self.gridIndex("_zusatz"))
+        self.execute(c, self.modifiedIndex("_zusatz", "changed"))
+
+    def gridIndex(self, suffix):
+        return "CREATE INDEX IF NOT EXISTS grid" + suffix + " ON " + self.tabellenname + suffix + \
+               " (cell, lat_int, lon_int)"
+
+    def modifiedIndex(self, suffix, column):
+        return "CREATE INDEX IF NOT EXISTS modified" + suffix + " ON " + self.tabellenname + suffix + \
+               " (" + column + ")"
+
+    def addDeltaSync(self):
+        # tombstones of deleted rows, and the changed column and its index used by /changes
+        conn = self.getConn()
+        c = conn.cursor()
+        stmt = "CREATE TABLE IF NOT EXISTS tombstones (tablename VARCHAR(100) NOT NULL, creator VARCHAR(40), " \
+               "created DATETIME, modified DATETIME, lat_round VARCHAR(20), lon_round VARCHAR(20), " \
+               "image_path VARCHAR(256), nr INTEGER, deleted DATETIME NOT NULL, INDEX (tablename, deleted))"
+        self.execute(c, stmt)
+        for (suffix, column) in [("_daten", "modified"), ("_images", "created"), ("_zusatz", "modified")]:
+            stmt = "SELECT count(*) FROM information_schema.tables WHERE table_schema = 'locationsdb' " \
+                   "AND table_name = %s"
+            self.execute(c, stmt, [self.tabellenname + suffix])
+            val = c.fetchone()
+            if val[0] == 1:
+                self.addChangedColumn(c, suffix, column)
+        conn.commit()
+
+    def addChangedColumn(self, c, suffix, column):
+        # tables of before the changed column get it, starting with the client time of their rows
+        tablename = self.tabellenname + suffix
+        stmt = "SELECT count(*) FROM information_schema.columns WHERE table_schema = 'locationsdb' " \
+               "AND table_name = %s AND column_name = 'changed'"
+        self.execute(c, stmt, [tablename])
+        if c.fetchone()[0] == 1:
+            return
+        self.execute(c, "ALTER TABLE " + tablename + " ADD " + changedField)
+        self.execute(c, "UPDATE " + tablename + " SET changed = " + column)
+        self.execute(c, "DROP INDEX IF EXISTS modified" + suffix + " ON " + tablename)  # it was on column
+        self.execute(c, self.modifiedIndex(suffix, "changed"))
+        print("changed column added to", tablename)
+
+    def addSpatialColumns(self):
+        # migrate tables created before the spatial keys existed, see spatial.py
+        conn = self.getConn()
+        c = conn.cursor()
+        for suffix in ["_daten", "_images", "_zusatz"]:
+            tablename = self.tabellenname + suffix
+            stmt = "SELECT count(*) FROM information_schema.columns WHERE table_schema = 'locationsdb' " \
+                   "AND table_name = %s AND column_name IN ('lat_round', 'cell')"
+            self.execute(c, stmt, [tablename])
+            val = c.fetchone()
+            if val[0] != 1:  # no such table, or already migrated
+                continue
+            self.execute(c, "ALTER TABLE " + tablename + " ADD " + ", ADD ".join(spatialFields))
+            self.execute(c, "UPDATE " + tablename + " SET lat_int = ROUND(lat_round * " + str(spatial.SCALE) +
+                      "), lon_int = ROUND(lon_round * " + str(spatial.SCALE) + ")")
+            self.execute(c, "UPDATE " + tablename + " SET cell = (FLOOR(lat_int / " + str(spatial.GRID_STEP) + ") + " +
+                      str(spatial.LAT_OFFSET) + ") * " + str(spatial.LON_CELLS) +
+                      " + FLOOR(lon_int / " + str(spatial.GRID_STEP) + ") + " + str(spatial.LON_OFFSET))
+            self.execute(c, self.gridIndex(suffix))
+            conn.commit()
+            print("spatial keys added to", tablename)
 
-    def updateDB(self, baseJS, configs):
+    def updateDB(self, baseJS, configs, online=False):
         self.baseJS = baseJS
         self.tabellenname = self.baseJS.get("db_tabellenname")
+        self.timings = []
+        try:
+            self.migrate(baseJS, configs, online)
+        finally:
+            self.close()
+        self.printTimings()
+
+    def migrate(self, baseJS, configs, online):
         bcVers = baseJS["version"]
         dbVers = self.dbVersion()
         if dbVers == 0:  # a new table
@@ -98,56 +224,61 @@ class MySqlCreateTables:
             stmt = "CREATE TABLE IF NOT EXISTS versions (tablename VARCHAR(100), version INT)"
             conn = self.getConn()
             c = conn.cursor()
-            c.execute(stmt)
+            self.execute(c, stmt)
             stmt = "INSERT INTO versions (tablename, version) VALUES(%(tablename)s, %(version)s)"
-            c.execute(stmt, {'tablename': self.tabellenname, 'version': baseJS["version"]})
+            self.execute(c, stmt, {'tablename': self.tabellenname, 'version': baseJS["version"]})
             conn.commit()
 
             stmt = "CREATE TABLE IF NOT EXISTS users (email VARCHAR(100) PRIMARY KEY, username VARCHAR(100), " \
                    "encpw  VARCHAR(100), UNIQUE(username)) "
-            conn = self.getConn()
-            c = conn.cursor()
-            c.execute(stmt)
+            self.execute(c, stmt)
             conn.commit()
+            self.addDeltaSync()
 
             return
+        self.addSpatialColumns()
+        self.addDeltaSync()
         if bcVers > dbVers:
-            self.updateFields(bcVers, dbVers, configs)
+            self.updateFields(bcVers, dbVers, configs, online)
 
     def dbVersion(self):
         conn = self.getConn()
         c = conn.cursor()
         stmt = "SELECT count(*) FROM information_schema.tables WHERE table_schema = 'locationsdb' AND table_name = %s"
-        c.execute(stmt, [self.tabellenname + "_daten"])
+        self.execute(c, stmt, [self.tabellenname + "_daten"])
         val = c.fetchone()
         if val[0] == 0:
             return 0
         try:
             stmt = "SELECT max(version) FROM versions WHERE tablename = %s"
-            c.execute(stmt, [self.tabellenname])
+            self.execute(c, stmt, [self.tabellenname])
             val = c.fetchone()
             return 1 if val is None or val[0] is None else val[0]
         except Exception as err:
             pass
         return 1
 
-    def updateFields(self, bcVers, dbVers, configs):
+    def updateFields(self, bcVers, dbVers, configs, online):
         dbConfigArr = [c for c in configs if c["version"] == dbVers]
         if len(dbConfigArr) == 0:
             raise Exception("no config file " + self.tabellenname + "_" + str(dbVers) + " found")
         dbConfig = dbConfigArr[0]
         diffs = self.getDiffs(dbConfig)
         (addedDaten, removedDaten, addedZusatz, removedZusatz) = diffs
-        self.addFields(addedDaten, "_daten")
-        self.removeFields(removedDaten, "_daten")
-        self.addFields(addedZusatz, "_zusatz")
-        self.removeFields(removedZusatz, "_zusatz")
-        stmt = "UPDATE versions SET version=%(version)s WHERE tablename = %(tablename)s"
         conn = self.getConn()
         c = conn.cursor()
-        c.execute(stmt, {'tablename': self.tabellenname, 'version': bcVers})
+        for (suffix, added, removed) in [("_daten", addedDaten, removedDaten),
+                                         ("_zusatz", addedZusatz, removedZusatz)]:
+            if online and len(added) + len(removed) > 0:
+                onlineMigration.OnlineMigration(self, suffix, added, removed).run()
+                continue
+            stmt = self.alterStatement(suffix, added, removed)
+            if stmt is not None:
+                self.execute(c, stmt, step="ALTER TABLE " + self.tabellenname + suffix +
+                             " (%d added, %d removed)" % (len(added), len(removed)))
+        stmt = "UPDATE versions SET version=%(version)s WHERE tablename = %(tablename)s"
+        self.execute(c, stmt, {'tablename': self.tabellenname, 'version': bcVers})
         conn.commit()
-        pass
 
     def getDiffs(self, oldJS):
         newJS = self.baseJS
@@ -172,33 +303,28 @@ class MySqlCreateTables:
         return l
 
     def fieldBefore(self, name, suffix):
-        felder = self.baseJS.get(suffix)
-        if felder is None:
+        js = self.baseJS.get(suffix)
+        if js is None:
             return ""
+        felder = js["felder"]
         for (i, f) in enumerate(felder):
             if f["name"] == name:
-                if i == 0:
-                    return " FIRST"
+                if i == 0:  # the config fields follow the fixed columns, see initDB
+                    return " AFTER lon_round"
                 return " AFTER " + felder[i - 1]["name"]
         return ""
 
-    def addFields(self, addedFields, suffix):
-        conn = self.getConn()
-        c = conn.cursor()
-        for feld in addedFields:
-            stmt = "ALTER TABLE " + self.tabellenname + suffix + " ADD " + \
-                   feld["name"] + " " + sqtype[feld["type"]] + \
-                   self.fieldBefore(feld["name"], suffix[1:])
-            c.execute(stmt)
-        conn.commit()
-
-    def removeFields(self, removedFields, suffix):
-        conn = self.getConn()
-        c = conn.cursor()
-        for feld in removedFields:
-            stmt = "ALTER TABLE " + self.tabellenname + suffix + " DROP " + feld["name"]
-            c.execute(stmt)
-        conn.commit()
+    def alterStatement(self, suffix, addedFields, removedFields, tablename=None):
+        # one ALTER TABLE for all changes of a table, so that InnoDB rebuilds it only once.
+        # The added fields are in config order, so an AFTER may name a field added just before.
+        changes = ["ADD " + feld["name"] + " " + sqtype[feld["type"]] + self.fieldBefore(feld["name"], suffix[1:])
+                   for feld in addedFields]
+        changes.extend("DROP " + feld["name"] for feld in removedFields)
+        if len(changes) == 0:
+            return None
+        if tablename is None:
+            tablename = self.tabellenname + suffix
+        return "ALTER TABLE " + tablename + " " + ", ".join(changes)
 
 
 class App:
@@ -223,3 +349,8 @@ if __name__ == "__main__":
                 baseJS = bv
                 vers = bv["version"]
         db.initDB(baseJS)
+    for name in app.baseConfig.getNames():
+        db.tabellenname = app.baseConfig.getBaseVersions(name)[0]["db_tabellenname"]
+        db.addSpatialColumns()
+        db.addDeltaSync()
+    db.close()
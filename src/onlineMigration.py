@@ -0,0 +1,132 @@
+import time
+
+import paging
+
+"""
+Online migration of a _daten or _zusatz table, for tables too big to ALTER in place:
+the ALTER would block /add and /region until InnoDB has rebuilt the whole table.
+  1. create <table>_new LIKE <table> and ALTER the empty copy
+  2. triggers on <table> repeat every insert, update and delete in <table>_new
+  3. copy the rows in primary key order, CHUNK_SIZE rows per INSERT IGNORE ... SELECT and
+     transaction, so rows written by the triggers meanwhile are not overwritten with older data
+  4. RENAME TABLE swaps both tables in one step, then the old table and its triggers are dropped
+Progress and throughput are printed every REPORT_SECONDS. If anything fails before the swap,
+triggers and shadow table are dropped and the live table is left as it was.
+Creating triggers needs the TRIGGER privilege for creator, see MySqlCreateTables.mysqlConnect,
+and with binary logging also log_bin_trust_function_creators.
+"""
+
+CHUNK_SIZE = 2000
+REPORT_SECONDS = 5
+
+
+class OnlineMigration:
+    def __init__(self, db, suffix, addedFields, removedFields, chunkSize=CHUNK_SIZE, pause=0.0):
+        self.db = db  # MySqlCreateTables, whose connection and timings are used
+        self.table = db.tabellenname + suffix
+        self.shadow = self.table + "_new"
+        self.old = self.table + "_old"
+        self.suffix = suffix
+        self.addedFields = addedFields
+        self.removedFields = removedFields
+        self.chunkSize = chunkSize
+        self.pause = pause  # seconds between chunks, to leave room for the app under load
+        self.triggers = [self.table + "_oi", self.table + "_ou", self.table + "_od"]
+
+    def run(self):
+        conn = self.db.getConn()
+        c = conn.cursor()
+        self.columns = [col for col in self.tableColumns(c) if col not in [f["name"] for f in self.removedFields]]
+        self.keyColumns = self.primaryKey(c)
+        try:
+            self.db.execute(c, "DROP TABLE IF EXISTS " + self.shadow)  # left over from a failed run
+            self.db.execute(c, "CREATE TABLE " + self.shadow + " LIKE " + self.table)
+            self.db.execute(c, self.db.alterStatement(self.suffix, self.addedFields, self.removedFields,
+                                                      self.shadow),
+                            step="ALTER TABLE " + self.shadow)
+            self.createTriggers(c)
+            self.copy(conn, c)
+        except Exception:
+            self.dropTriggers(c)
+            self.db.execute(c, "DROP TABLE IF EXISTS " + self.shadow)
+            raise
+        self.db.execute(c, "RENAME TABLE " + self.table + " TO " + self.old + ", " + self.shadow + " TO " + self.table)
+        self.dropTriggers(c)  # they moved with the table to _old
+        self.db.execute(c, "DROP TABLE " + self.old)
+        conn.commit()
+
+    def tableColumns(self, c):
+        stmt = "SELECT column_name FROM information_schema.columns WHERE table_schema = 'locationsdb' " \
+               "AND table_name = %s ORDER BY ordinal_position"
+        self.db.execute(c, stmt, [self.table])
+        return [row[0] for row in c.fetchall()]
+
+    def primaryKey(self, c):
+        stmt = "SELECT column_name FROM information_schema.key_column_usage WHERE table_schema = 'locationsdb' " \
+               "AND table_name = %s AND constraint_name = 'PRIMARY' ORDER BY ordinal_position"
+        self.db.execute(c, stmt, [self.table])
+        return [row[0] for row in c.fetchall()]
+
+    def createTriggers(self, c):
+        cols = ", ".join(self.columns)
+        replace = "REPLACE INTO " + self.shadow + " (" + cols + ") VALUES (" + \
+                  ", ".join("NEW." + col for col in self.columns) + ")"
+        delete = "DELETE FROM " + self.shadow + " WHERE " + \
+                 " AND ".join(k + " = OLD." + k for k in self.keyColumns)
+        (ins, upd, dele) = self.triggers
+        self.db.execute(c, "CREATE TRIGGER " + ins + " AFTER INSERT ON " + self.table + " FOR EACH ROW " + replace)
+        self.db.execute(c, "CREATE TRIGGER " + upd + " AFTER UPDATE ON " + self.table + " FOR EACH ROW BEGIN " +
+                        delete + "; " + replace + "; END")
+        self.db.execute(c, "CREATE TRIGGER " + dele + " AFTER DELETE ON " + self.table + " FOR EACH ROW " + delete)
+
+    def dropTriggers(self, c):
+        for trigger in self.triggers:
+            self.db.execute(c, "DROP TRIGGER IF EXISTS " + trigger)
+
+    def estimatedRows(self, c):
+        stmt = "SELECT table_rows FROM information_schema.tables WHERE table_schema = 'locationsdb' " \
+               "AND table_name = %s"
+        self.db.execute(c, stmt, [self.table])
+        val = c.fetchone()
+        return 0 if val is None or val[0] is None else val[0]
+
+    def copy(self, conn, c):
+        cols = ", ".join(self.columns)
+        keys = ", ".join(self.keyColumns)
+        total = self.estimatedRows(c)
+        copied = 0
+        lastKey = None
+        t0 = time.perf_counter()
+        reported = t0
+        while True:
+            (where, parms) = ("", {}) if lastKey is None else \
+                paging.keyAfter(self.keyColumns, lastKey, prefix="after", pyformat=True)
+            # the key of the last row of this chunk, None for the last chunk
+            c.execute("SELECT " + keys + " FROM " + self.table + ("" if where == "" else " WHERE " + where) +
+                      " ORDER BY " + keys + " LIMIT " + str(self.chunkSize - 1) + ", 1", parms)
+            endKey = c.fetchone()
+            conds = [] if where == "" else [where]
+            if endKey is not None:
+                (upTo, upToParms) = paging.keyAfter(self.keyColumns, list(endKey), "<=", "upto", pyformat=True)
+                conds.append(upTo)
+                parms = dict(parms, **upToParms)
+            c.execute("INSERT IGNORE INTO " + self.shadow + " (" + cols + ") SELECT " + cols + " FROM " + self.table +
+                      ("" if len(conds) == 0 else " WHERE " + " AND ".join(conds)), parms)
+            copied += c.rowcount
+            conn.commit()
+            now = time.perf_counter()
+            if endKey is None or now - reported >= REPORT_SECONDS:
+                reported = now
+                self.report(copied, total, now - t0)
+            if endKey is None:
+                break
+            lastKey = list(endKey)
+            if self.pause > 0:
+                time.sleep(self.pause)
+        self.db.timings.append(("copy " + self.table + " (%d rows)" % copied, time.perf_counter() - t0))
+
+    def report(self, copied, total, secs):
+        percent = "" if total == 0 else " of ~%d (%d%%)" % (total, min(100, 100 * copied // total))
+        rate = copied / secs if secs > 0 else 0
+        print("online migration of %s: %d rows%s copied in %.1fs, %.0f rows/s" %
+              (self.table, copied, percent, secs, rate))
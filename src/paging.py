@@ -0,0 +1,41 @@
+import base64
+import json
+
+"""
+Keyset pagination for /table and /region: a page is ordered by the primary key, and the next
+page starts after the key of the last row. For /table that is a range scan of the primary key
+however deep the client has paged. /region reads the rows of the viewport through the grid
+index, the key condition only skips the rows of the earlier pages, so every page of a viewport
+costs a scan and sort of its rows, but no OFFSET.
+The cursor handed to the client is that key, as base64 encoded JSON.
+keyAfter is also used by onlineMigration.py, with the pyformat parameters of mysql.connector.
+"""
+
+
+def encodeCursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key), separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decodeCursor(cursor, keyLength):
+    # raises ValueError for anything that is not a cursor of this table
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(key, list) or len(key) != keyLength:
+        raise ValueError("invalid cursor")
+    return key
+
+
+def keyAfter(names, key, op=">", prefix="key", pyformat=False):
+    # (k1, k2, ...) op key as OR terms, which MySQL can answer with a range on the primary key.
+    # op is > or >=, < or <=, the parameters are :<prefix>N, or %(<prefix>N)s with pyformat.
+    terms = []
+    parms = {}
+    for i in range(len(names)):
+        marker = [("%(" + prefix + str(j) + ")s") if pyformat else (":" + prefix + str(j)) for j in range(i + 1)]
+        last = i == len(names) - 1
+        terms.append("(" + " AND ".join([names[j] + " = " + marker[j] for j in range(i)] +
+                                        [names[i] + " " + (op if last else op[0]) + " " + marker[i]]) + ")")
+        parms[prefix + str(i)] = key[i]
+    return "(" + " OR ".join(terms) + ")", parms
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+
+import spatial
+
+"""
+Results of /region, cached per table, region filter and grid tile (the GRID_STEP cells of
+spatial.py). A viewport is answered from the tiles it covers, and only the missing tiles are
+read from the database, so overlapping viewports share their tiles.
+Writers call invalidate() with the positions of the rows they changed, after their commit.
+Every invalidation also bumps the generation of the table, and a reader only stores what it
+read if the generation did not change meanwhile, so a result read before a commit never
+ends up in the cache after the invalidation for that commit.
+The cache is per process: with more than one WSGI process a write is invisible to the caches
+of the others, so app.py does not use it then. Other writers of the same database (bulkData.py,
+the migrations, a second server, manual SQL) do not invalidate anything either, so every tile
+expires ttl seconds after it was read: their rows show up after ttl seconds at the latest.
+"""
+
+
+class RegionCache:
+    def __init__(self, maxRows, maxTiles, ttl):
+        self.maxRows = maxRows  # rows kept in all tiles together
+        self.maxTiles = maxTiles  # bigger viewports are not cached
+        self.ttl = ttl  # seconds
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (tablename, region, row, col) -> (expires, [(lat_int, lon_int, row)]), LRU first
+        self.byTile = {}  # (tablename, row, col) -> set of entry keys, for invalidate
+        self.generations = {}  # tablename -> count of invalidations
+        self.rows = 0
+
+    def tiles(self, minLat, maxLat, minLon, maxLon):
+        # the (row, col) tiles covering the scaled bbox, or None if there are more than maxTiles
+        (row0, row1) = (spatial.gridRow(minLat), spatial.gridRow(maxLat))
+        (col0, col1) = (spatial.gridCol(minLon), spatial.gridCol(maxLon))
+        if max(row1 - row0 + 1, 0) * max(col1 - col0 + 1, 0) > self.maxTiles:
+            return None
+        return [(r, c) for r in range(row0, row1 + 1) for c in range(col0, col1 + 1)]
+
+    def lookup(self, tablename, region, tiles):
+        # returns the cached tiles as {(row, col): rows}, and the generation to pass to store()
+        found = {}
+        now = time.monotonic()
+        with self.lock:
+            for (r, c) in tiles:
+                key = (tablename, region, r, c)
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    self.remove(key)
+                    continue
+                self.entries.move_to_end(key)
+                found[(r, c)] = entry[1]
+            return found, self.generations.get(tablename, 0)
+
+    def store(self, tablename, region, generation, tileRows):
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            if self.generations.get(tablename, 0) != generation:
+                return
+            for ((r, c), rows) in tileRows.items():
+                key = (tablename, region, r, c)
+                self.remove(key)
+                self.entries[key] = (expires, rows)
+                self.byTile.setdefault((tablename, r, c), set()).add(key)
+                self.rows += len(rows) + 1  # empty tiles count too
+            while self.rows > self.maxRows:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.rows -= len(entry[1]) + 1
+        tile = (key[0], key[2], key[3])
+        keys = self.byTile[tile]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.byTile[tile]
+
+    def invalidate(self, tablename, cells):
+        # cells as in the cell column of the table
+        with self.lock:
+            self.generations[tablename] = self.generations.get(tablename, 0) + 1
+            for cell in cells:
+                tile = (tablename, cell // spatial.LON_CELLS, cell % spatial.LON_CELLS)
+                for key in list(self.byTile.get(tile, ())):
+                    self.remove(key)
+
+    def invalidateTable(self, tablename):
+        with self.lock:
+            self.generations[tablename] = self.generations.get(tablename, 0) + 1
+            for key in [key for key in self.entries if key[0] == tablename]:
+                self.remove(key)
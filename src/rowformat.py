@@ -0,0 +1,48 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+"""
+Response formats for the row endpoints (/table, /region), chosen by the Accept header.
+JSON arrays of row arrays stay the default. The columnar formats send the column names and
+types once and then one value array per column:
+  {"columns": ["creator", "created", ...], "types": ["string", "datetime", ...], "data": [[...], [...], ...]}
+as JSON (COLUMNAR) or, if msgpack is installed, as MessagePack (MSGPACK).
+Datetimes and Decimals are converted by the default function passed in, like DecEncoder does for JSON.
+"""
+
+JSON = "application/json"
+COLUMNAR = "application/vnd.locations.columnar+json"
+MSGPACK = "application/vnd.locations.columnar+msgpack"
+
+formats = [JSON, COLUMNAR] + ([] if msgpack is None else [MSGPACK])
+
+typeNames = {"int": "int", "float": "float", "Decimal": "float", "str": "string", "datetime": "datetime",
+             "date": "date", "bool": "bool", "bytes": "bytes"}
+
+
+def negotiate(acceptMimetypes):
+    # JSON for clients that send no Accept header, or */*
+    return acceptMimetypes.best_match(formats, default=JSON) or JSON
+
+
+def typeName(col):
+    try:
+        return typeNames.get(col.type.python_type.__name__, "string")
+    except NotImplementedError:
+        return "string"
+
+
+def columnar(columns, rows):
+    data = [list(values) for values in zip(*rows)] if len(rows) > 0 else [[] for _ in columns]
+    return {"columns": [col.name for col in columns], "types": [typeName(col) for col in columns], "data": data}
+
+
+def encode(fmt, columns, rows, default):
+    obj = columnar(columns, rows)
+    if fmt == MSGPACK:
+        return msgpack.packb(obj, default=default, use_bin_type=True)
+    return json.dumps(obj, default=default, separators=(",", ":"))
@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+"""
+Session state: the key agreed in /kex, and user name and login date set by /auth.
+MemoryStore keeps the sessions of one process in an LRU dict, SqliteStore keeps them in a
+sqlite file that all WSGI processes of the server share. Both drop a session ttl seconds
+after its login (or after its key exchange, if it never logged in), and never hold more
+than maxSize sessions. login() raises KeyError if the session is gone, i.e. /auth fails.
+"""
+
+Session = namedtuple("Session", ["sharedKey", "username", "loginDate"])
+
+
+class MemoryStore:
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()  # id -> (Session, since), least recently used first
+
+    def get(self, id2):
+        with self.lock:
+            entry = self.sessions.get(id2)
+            if entry is None:
+                return None
+            if entry[1] < time.time() - self.ttl:
+                del self.sessions[id2]
+                return None
+            self.sessions.move_to_end(id2)
+            return entry[0]
+
+    def setKey(self, id2, sharedKey):
+        with self.lock:
+            entry = self.sessions.get(id2)
+            if entry is None or entry[0].loginDate is None:
+                self.put(id2, Session(sharedKey, None, None), time.time())
+            else:
+                self.put(id2, entry[0]._replace(sharedKey=sharedKey), entry[1])
+
+    def login(self, id2, username, loginDate):
+        with self.lock:
+            (session, since) = self.sessions[id2]
+            if since < time.time() - self.ttl:
+                del self.sessions[id2]
+                raise KeyError(id2)
+            self.put(id2, session._replace(username=username, loginDate=loginDate), loginDate.timestamp())
+
+    def put(self, id2, session, since):
+        self.sessions[id2] = (session, since)
+        self.sessions.move_to_end(id2)
+        while len(self.sessions) > self.maxSize:
+            self.sessions.popitem(last=False)
+
+    def count(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+class SqliteStore:
+    def __init__(self, path, maxSize, ttl):
+        self.path = path
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.local = threading.local()
+        self.writes = 0
+        conn = self.conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, sharedkey BLOB, username TEXT, "
+                     "logindate REAL, since REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_since ON sessions (since)")
+
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def get(self, id2):
+        row = self.conn().execute("SELECT sharedkey, username, logindate FROM sessions WHERE id = ? AND since >= ?",
+                                  (id2, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        loginDate = None if row[2] is None else datetime.fromtimestamp(row[2])
+        return Session(bytes(row[0]), row[1], loginDate)
+
+    def setKey(self, id2, sharedKey):
+        # a new key exchange keeps an existing login
+        self.conn().execute("INSERT INTO sessions (id, sharedkey, since) VALUES (?, ?, ?) ON CONFLICT (id) "
+                            "DO UPDATE SET sharedkey = excluded.sharedkey, "
+                            "since = CASE WHEN logindate IS NULL THEN excluded.since ELSE since END",
+                            (id2, sharedKey, time.time()))
+        self.written()
+
+    def login(self, id2, username, loginDate):
+        ts = loginDate.timestamp()
+        r = self.conn().execute("UPDATE sessions SET username = ?, logindate = ?, since = ? "
+                                "WHERE id = ? AND since >= ?", (username, ts, ts, id2, time.time() - self.ttl))
+        if r.rowcount == 0:  # expired or evicted since /kex
+            raise KeyError(id2)
+        self.written()
+
+    def written(self):
+        self.writes += 1
+        if self.writes % 100 != 0:
+            return
+        conn = self.conn()
+        conn.execute("DELETE FROM sessions WHERE since < ?", (time.time() - self.ttl,))
+        conn.execute("DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY since DESC "
+                     "LIMIT -1 OFFSET ?)", (self.maxSize,))
+
+    def count(self):
+        return self.conn().execute("SELECT count(*) FROM sessions WHERE since >= ?",
+                                   (time.time() - self.ttl,)).fetchone()[0]
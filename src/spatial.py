@@ -0,0 +1,86 @@
+from decimal import Decimal, InvalidOperation, ROUND_CEILING, ROUND_FLOOR, ROUND_HALF_EVEN
+
+"""
+Numeric spatial keys for the location tables.
+lat_round and lon_round are VARCHARs, so range queries on them compare strings and the
+(lat_round, lon_round) index only narrows on lat_round. Every row therefore also carries
+lat_int/lon_int (the coordinate scaled by SCALE) and cell, the number of its GRID_STEP sized
+cell in a row-major grid. A bounding box becomes one cell range per grid row, which the
+(cell, lat_int, lon_int) index can answer directly.
+"""
+
+SCALE_DIGITS = 7
+SCALE = 10 ** SCALE_DIGITS
+GRID_STEP = SCALE // 100  # 0.01 degrees, about 1.1 km in latitude
+LAT_OFFSET = 90 * SCALE // GRID_STEP
+LON_OFFSET = 180 * SCALE // GRID_STEP
+LON_CELLS = 2 * LON_OFFSET + 1
+MAX_GRID_ROWS = 64  # more grid rows in a bbox are scanned as one cell range
+
+SPATIAL_COLUMNS = ("lat_int", "lon_int", "cell")
+
+
+def toInt(val, rounding=ROUND_HALF_EVEN):
+    return int(Decimal(str(val)).scaleb(SCALE_DIGITS).to_integral_value(rounding))
+
+
+def gridRow(latInt):
+    return latInt // GRID_STEP + LAT_OFFSET
+
+
+def gridCol(lonInt):
+    return lonInt // GRID_STEP + LON_OFFSET
+
+
+def cellOf(latInt, lonInt):
+    return gridRow(latInt) * LON_CELLS + gridCol(lonInt)
+
+
+def addKeys(row):
+    latInt = toInt(row["lat_round"])
+    lonInt = toInt(row["lon_round"])
+    row["lat_int"] = latInt
+    row["lon_int"] = lonInt
+    row["cell"] = cellOf(latInt, lonInt)
+    return row
+
+
+def cellBounds(row0, row1, col0, col1):
+    # the scaled bbox covering grid rows row0..row1 and columns col0..col1
+    return ((row0 - LAT_OFFSET) * GRID_STEP, (row1 + 1 - LAT_OFFSET) * GRID_STEP - 1,
+            (col0 - LON_OFFSET) * GRID_STEP, (col1 + 1 - LON_OFFSET) * GRID_STEP - 1)
+
+
+def hasKeys(dbtable):
+    return all(col in dbtable.c for col in SPATIAL_COLUMNS)
+
+
+def bbox(minlat, maxlat, minlon, maxlon):
+    # lat_round >= minlat <=> lat_int >= ceil(minlat * SCALE), as lat_round has at most SCALE_DIGITS decimals.
+    # ValueError if one of them is not a number.
+    try:
+        return (toInt(minlat, ROUND_CEILING), toInt(maxlat, ROUND_FLOOR),
+                toInt(minlon, ROUND_CEILING), toInt(maxlon, ROUND_FLOOR))
+    except (InvalidOperation, OverflowError):  # not a number, or infinite
+        raise ValueError("minlat, maxlat, minlon and maxlon must be numbers")
+
+
+def intFilter(minLat, maxLat, minLon, maxLon):
+    # the condition on the spatial keys for a bbox scaled by SCALE, see bbox()
+    parms = {"minlat": minLat, "maxlat": maxLat, "minlon": minLon, "maxlon": maxLon}
+    row0 = gridRow(minLat)
+    row1 = gridRow(maxLat)
+    col0 = gridCol(minLon)
+    col1 = gridCol(maxLon)
+    if row1 < row0 or row1 - row0 >= MAX_GRID_ROWS:
+        ranges = [(row0 * LON_CELLS + col0, row1 * LON_CELLS + col1)]
+    else:
+        ranges = [(r * LON_CELLS + col0, r * LON_CELLS + col1) for r in range(row0, row1 + 1)]
+    conds = []
+    for (i, (c0, c1)) in enumerate(ranges):
+        conds.append("cell BETWEEN :cell" + str(i) + "a AND :cell" + str(i) + "b")
+        parms["cell" + str(i) + "a"] = c0
+        parms["cell" + str(i) + "b"] = c1
+    sql = "(" + " OR ".join(conds) + ")" + \
+          " AND lat_int BETWEEN :minlat AND :maxlat AND lon_int BETWEEN :minlon AND :maxlon"
+    return sql, parms
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from sqlalchemy import MetaData, Table, inspect
+from sqlalchemy.exc import NoSuchTableError
+
+"""
+Reflected tables, loaded on first use instead of reflecting the whole database at startup.
+Entries are dropped by invalidate() after a schema migration in this process, and are
+reflected again after ttl seconds anyway, so that migrations done by another WSGI process
+(and tables it created) show up too.
+Only names in the table list of the database are reflected and cached, the list is read again
+after ttl seconds as well, so names from arbitrary URLs do not fill the cache.
+"""
+
+
+class TableCache:
+    def __init__(self, engine, ttl):
+        self.engine = engine
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.tables = {}  # name -> Table
+        self.loaded = {}  # name -> time of reflection
+        self.names = set()  # the tables of the database
+        self.namesLoaded = None  # time of get_table_names()
+
+    def __getitem__(self, name):
+        now = time.monotonic()
+        if self.namesLoaded is None or now - self.namesLoaded > self.ttl:
+            with self.lock:
+                self.loadNames(now)
+        if name not in self.names:
+            raise KeyError(name)
+        loadedAt = self.loaded.get(name)
+        if loadedAt is None or now - loadedAt > self.ttl:
+            with self.lock:
+                self.load(name, now)
+        table = self.tables.get(name)
+        if table is None:
+            raise KeyError(name)
+        return table
+
+    def __contains__(self, name):
+        try:
+            self[name]
+            return True
+        except KeyError:
+            return False
+
+    def loadNames(self, now):
+        if self.namesLoaded is not None and now - self.namesLoaded <= self.ttl:
+            return
+        self.names = set(inspect(self.engine).get_table_names())
+        for name in [name for name in self.tables if name not in self.names]:  # dropped tables
+            del self.tables[name]
+            self.loaded.pop(name, None)
+        self.namesLoaded = now
+
+    def load(self, name, now):
+        loadedAt = self.loaded.get(name)
+        if loadedAt is not None and now - loadedAt <= self.ttl:  # loaded by another thread meanwhile
+            return
+        try:
+            # each table gets its own MetaData, so a reload just replaces the entry
+            self.tables[name] = Table(name, MetaData(), autoload=True, autoload_with=self.engine)
+        except NoSuchTableError:  # dropped since loadNames
+            self.tables.pop(name, None)
+        self.loaded[name] = now
+
+    def invalidate(self, names):
+        with self.lock:
+            self.namesLoaded = None  # the migration may have created tables
+            for name in names:
+                self.loaded.pop(name, None)
+
+    def keys(self):
+        return inspect(self.engine).get_table_names()
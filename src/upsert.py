@@ -0,0 +1,95 @@
+from sqlalchemy import UniqueConstraint, text
+
+"""
+Insert-or-update for the location tables: a row that exists already is updated in place and
+keeps its key, e.g. the nr of _zusatz, so clients that synced that key still find the row.
+MySQL: INSERT ... ON DUPLICATE KEY UPDATE, for whichever unique key collides.
+sqlite: INSERT ... ON CONFLICT (key) DO UPDATE, one clause for each unique key the rows contain,
+so _zusatz rows without nr are matched by their natural key (creator, created, modified, position).
+Rows are sent in batches of BATCH_SIZE with executemany, inside the caller's transaction.
+The counts of inserted and updated rows: MySQL's affected rows cannot tell them apart, as SQLAlchemy
+connects with CLIENT_FOUND_ROWS (an update that changes nothing counts 1, like an insert), so the rows
+that exist already are counted before each batch. sqlite counts the new rowids and total_changes().
+"""
+
+BATCH_SIZE = 500
+CHANGED_COLUMN = "changed"  # set by the database on every insert and update, see mysqlCreateTables.py
+
+
+def uniqueKeys(dbtable):
+    keys = []
+    pk = tuple(col.name for col in dbtable.primary_key.columns)
+    if len(pk) > 0:
+        keys.append(pk)
+    for cons in dbtable.constraints:
+        if isinstance(cons, UniqueConstraint):
+            keys.append(tuple(col.name for col in cons.columns))
+    for idx in dbtable.indexes:  # mysql reflects UNIQUE constraints as unique indexes
+        if idx.unique:
+            keys.append(tuple(col.name for col in idx.columns))
+    return list(dict.fromkeys(keys))
+
+
+def statement(dialect, dbtable, columns):
+    q = dialect.identifier_preparer.quote
+    keys = uniqueKeys(dbtable)
+    cols = "(" + ", ".join(q(c) for c in columns) + ")"
+    values = "(" + ", ".join(":" + c for c in columns) + ")"
+    if dialect.name == "mysql":
+        updates = ", ".join(q(c) + " = VALUES(" + q(c) + ")" for c in columns)
+        return "INSERT INTO " + q(dbtable.name) + " " + cols + " VALUES " + values + \
+               " ON DUPLICATE KEY UPDATE " + updates
+    if dialect.name == "sqlite":
+        clauses = []
+        for key in [key for key in keys if all(c in columns for c in key)]:
+            updates = ", ".join(q(c) + " = excluded." + q(c) for c in columns if c not in key)
+            action = "DO NOTHING" if updates == "" else "DO UPDATE SET " + updates
+            clauses.append(" ON CONFLICT (" + ", ".join(q(c) for c in key) + ") " + action)
+        return "INSERT INTO " + q(dbtable.name) + " " + cols + " VALUES " + values + "".join(clauses)
+    raise ValueError("Kein Upsert für Datenbank " + dialect.name)
+
+
+def existingStatement(dialect, dbtable, columns, count):
+    # SELECT count(*) of the rows that count rows with these columns collide with, and the names of its parameters
+    q = dialect.identifier_preparer.quote
+    conds = []
+    names = []
+    for key in [key for key in uniqueKeys(dbtable) if all(c in columns for c in key)]:
+        idx = [columns.index(c) for c in key]
+        tuples = ["(" + ", ".join(":k%d_%d" % (i, j) for j in idx) + ")" for i in range(count)]
+        conds.append("(" + ", ".join(q(c) for c in key) + ") IN (" + ", ".join(tuples) + ")")
+        names.extend((i, j) for i in range(count) for j in idx)
+    if len(conds) == 0:
+        return None, names
+    return text("SELECT count(*) FROM " + q(dbtable.name) + " WHERE " + " OR ".join(conds)), names
+
+
+def upsert(conn, dbtable, rows):
+    # returns a list of (inserted, updated) per batch, and the lastrowid of the last batch
+    if len(rows) == 0:
+        return [], None
+    columns = [col.name for col in dbtable.columns if col.name in rows[0] and col.name != CHANGED_COLUMN]
+    stmt = text(statement(conn.dialect, dbtable, columns))
+    tablename = conn.dialect.identifier_preparer.quote(dbtable.name)
+    maxRowidStmt = text("SELECT (SELECT max(rowid) FROM " + tablename + "), total_changes()")
+    newRowsStmt = text("SELECT count(*), total_changes() FROM " + tablename + " WHERE rowid > :rowid")
+    counts = []
+    r = None
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch = rows[i:i + BATCH_SIZE]
+        if conn.dialect.name == "mysql":
+            (existingStmt, names) = existingStatement(conn.dialect, dbtable, columns, len(batch))
+            updated = 0
+            if existingStmt is not None:
+                parms = {"k%d_%d" % (n, j): batch[n][columns[j]] for (n, j) in names}
+                updated = conn.execute(existingStmt, parms).scalar()
+            r = conn.execute(stmt, batch)
+        else:
+            # new rows get a rowid above the old maximum, updates keep theirs; both count in total_changes()
+            (maxRowid, changesBefore) = conn.execute(maxRowidStmt).first()
+            r = conn.execute(stmt, batch)
+            (inserted, changesAfter) = conn.execute(newRowsStmt, {"rowid": maxRowid or 0}).first()
+            updated = changesAfter - changesBefore - inserted
+        updated = min(max(updated, 0), len(batch))
+        counts.append((len(batch) - updated, updated))
+    return counts, r.lastrowid
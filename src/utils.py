@@ -2,7 +2,8 @@ import io
 import os
 import sys
 import traceback
-from collections import Set, Mapping, deque
+from collections import deque
+from collections.abc import Set, Mapping
 from numbers import Number
 
 def printEx(msg, e):